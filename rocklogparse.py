@@ -9,22 +9,63 @@ It is unlikely the code will generalize to anything else.
 import datetime
 import csv
 import re
+import os
+import itertools
+import time
+
+import numpy as np
+
+# decimal numbers as they appear in logbook entries (temperatures, timestamps, energies)
+DECIMAL_PATTERN = re.compile(r'\d+.\d+')
+XRD_METADATA_DTYPE = [('Ti', 'f8'), ('Tf', 'f8'), ('ti', 'f8'), ('tf', 'f8'), ('eV', 'f8')]
 
 ##### General Logbook Parsing #####
 
+def read_column_array(log_file, indices, skiprows=2, names=None):
+    """Reads selected columns of a column-structured log as generated by some logger at ROCK.
+    The columns are separated by (any number of) spaces, including within the human-readable date
+    column, so each part of the date counts as a column, as for read_column_log. The whole file is
+    tokenized by NumPy's parser, which is much faster than splitting lines in Python.
+    Args:
+        - log_file (str): path to a space-delimited column-structured log file
+        - indices (iterable of int): of the columns to read, which must be numeric
+        - skiprows (int): header lines to skip
+        - names (iterable of str): field names of the columns; by default 'col<index>'
+    Returns:
+        - (structured array) one record per line, with one float field per index"""
+    indices = tuple(indices)
+    if names is None:
+        names = [f'col{idx}' for idx in indices]
+    dtype = [(name, 'f8') for name in names]
+    return np.loadtxt(log_file, dtype=dtype, usecols=indices, skiprows=skiprows, ndmin=1)
+
 def read_column_log(log_file, indices, skiprows=2):
-    """ NOT PREFERRED. When available, use pandas read instead. This was made to deal with a specific
-    problem in the ROCK logger, wherein the columns were space-delimited but had a column
+    """ NOT PREFERRED. Use read_column_array instead, or pandas read when available. This was made to
+    deal with a specific problem in the ROCK logger, wherein the columns were space-delimited but had a column
     whose entries (human-readable date) contained spaces themselves.
     Args:
         - path (str): to a space-delimited column-structured log file as generated by some logger at ROCK
     Returns:
         - (list of lists of ) data"""
-    with open(log_file, 'r') as f:
-        entries = f.readlines()[skiprows:]
-    split_entries = [row_string.split(' ') for row_string in entries]
-    ret = [[float(row[idx]) for idx in indices] for row in split_entries]
-    return ret
+    return [list(row) for row in read_column_array(log_file, indices, skiprows).tolist()]
+
+def iter_entries(lines, delimiter=''):
+    """Groups lines into logbook entries as they are read, without holding the whole file.
+    Args:
+        - lines (iterable of str): e.g. an open file, with any header already skipped
+        - delimiter (str): contents of the line that separates entries
+            after applying .strip(); e.g. '' for an empty line
+    Yields:
+        - (list of str) each logbook entry that is followed by a delimiter, as stripped lines"""
+    buffer = []
+    for line in lines:
+        line = line.strip()
+        if line == delimiter and len(buffer) > 0:
+            yield buffer
+            buffer = []
+            continue
+        if len(line) > 0:
+            buffer.append(line)
 
 def separate_entries(path, skiplines, delimiter=''):
     """Args:
@@ -35,18 +76,93 @@ def separate_entries(path, skiplines, delimiter=''):
     Returns:
         - (list of lists of str) One list each logbook entry, containing lines as strings."""
     with open(path, 'r') as lxf:
-        raw_lines = lxf.readlines()[skiplines:]
-        lines = [line.strip() for line in raw_lines]
-    entries = []
-    buffer = []
-    for line in lines:
-        if line == delimiter and len(buffer) > 0:
-            entries.append(buffer.copy())
-            buffer.clear()
-            continue
-        if len(line) > 0:
-            buffer.append(line)
-    return entries
+        return list(iter_entries(itertools.islice(lxf, skiplines, None), delimiter))
+
+class LogFollower:
+    """Follows a log file that is still being written, e.g. during a beamtime, remembering how far
+    it has been read so that each poll only parses what was appended since. Only complete lines
+    (ending in a newline) are consumed; a partially written line is read on a later poll.
+    If the file shrinks (e.g. it was replaced by the logger), it is read again from the top."""
+
+    def __init__(self, path, skiplines=0, delimiter=None, parse=None):
+        """Args:
+            - path (str): to the log file, which need not exist yet
+            - skiplines (int): header lines to skip at the top of the file
+            - delimiter (str): if None, lines are returned (as for a column log). Otherwise, lines
+                are grouped into entries as by separate_entries, and complete entries are returned.
+            - parse (callable): applied to each stripped line or entry before it is returned,
+                e.g. parse_XRD_entry for an XRD logbook"""
+        self.path = path
+        self.skiplines = skiplines
+        self.delimiter = delimiter
+        self.parse = parse
+        self.offset = 0 # bytes consumed
+        self._skip = skiplines
+        self._buffer = [] # lines of the entry being written
+
+    def reset(self):
+        """Starts reading from the top of the file again."""
+        self.offset = 0
+        self._skip = self.skiplines
+        self._buffer = []
+
+    def _new_lines(self):
+        try:
+            if os.stat(self.path).st_size < self.offset:
+                self.reset()
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return []
+        self.offset += end
+        lines = data[:end].decode().splitlines()
+        if self._skip > 0:
+            skipped = min(self._skip, len(lines))
+            self._skip -= skipped
+            lines = lines[skipped:]
+        return lines
+
+    def poll(self):
+        """Returns:
+            - (list) of lines (or entries, if a delimiter was given) appended since the last poll,
+                with parse applied if it was given"""
+        lines = self._new_lines()
+        if self.delimiter is None:
+            items = [line.strip() for line in lines if len(line.strip()) > 0]
+        else:
+            items = []
+            for line in lines:
+                line = line.strip()
+                if line == self.delimiter and len(self._buffer) > 0:
+                    items.append(self._buffer)
+                    self._buffer = []
+                elif len(line) > 0:
+                    self._buffer.append(line)
+        if self.parse is not None:
+            items = [self.parse(item) for item in items]
+        return items
+
+    def follow(self, interval=2., timeout=None):
+        """Polls the file, yielding new lines (or entries) as they arrive.
+        Args:
+            - interval (float): seconds between polls
+            - timeout (float): stop after this many seconds without new data; None to follow forever
+        Yields:
+            - each line or entry, as returned by poll"""
+        last_data = time.monotonic()
+        while True:
+            items = self.poll()
+            if len(items) > 0:
+                last_data = time.monotonic()
+                yield from items
+            elif timeout is not None and time.monotonic() - last_data > timeout:
+                return
+            else:
+                time.sleep(interval)
 
 def create_filename_dictionary(metadata, key_func):
     """Args:
@@ -75,20 +191,168 @@ def extract_logbook_XRD_metadata(entries):
             the (file path, sample temp. initial, sample temp. final, 
                     time initial, time final, monochromator eV)"""
     
-    metadata = []
-    for entry in entries:
-        # the strings corresponding to each
-        path = entry[1]
-        
-        temperatures = entry[3]
-        Ti = float(re.findall(r'\d+.\d+', temperatures[:len(temperatures)//2])[0])
-        Tf = float(re.findall(r'\d+.\d+', temperatures[len(temperatures)//2:])[0])
-                   
-        times = entry[4]
-        ti = float(re.findall(r'\d+.\d+', times[:len(times)//2])[0])
-        tf = float(re.findall(r'\d+.\d+', times[len(times)//2:])[0])
-        
-        eV = float(re.findall(r'\d+.\d+', entry[5])[0])
-                                  
-        metadata.append((path, Ti, Tf, ti, tf, eV))
-    return metadata
\ No newline at end of file
+    return [parse_XRD_entry(entry) for entry in entries]
+
+def parse_XRD_entry(entry):
+    """Args:
+        - entry (list of str): one entry of a speck3-generated logbook file, as yielded by iter_entries
+    Returns:
+        - (tuple) (file path, sample temp. initial, sample temp. final,
+                    time initial, time final, monochromator eV)"""
+    path = entry[1]
+    # the opening and closing values are the first numbers in each half of their lines
+    temperatures = entry[3]
+    Ti = float(DECIMAL_PATTERN.search(temperatures, 0, len(temperatures)//2).group())
+    Tf = float(DECIMAL_PATTERN.search(temperatures, len(temperatures)//2).group())
+    times = entry[4]
+    ti = float(DECIMAL_PATTERN.search(times, 0, len(times)//2).group())
+    tf = float(DECIMAL_PATTERN.search(times, len(times)//2).group())
+    eV = float(DECIMAL_PATTERN.search(entry[5]).group())
+    return (path, Ti, Tf, ti, tf, eV)
+
+def read_logbook_XRD_metadata(path, skiplines, delimiter='', cache=True):
+    """Parses a speck3-generated XRD logbook in a single pass into columns, i.e. the same
+    information as extract_logbook_XRD_metadata(separate_entries(...)).
+    The result is cached next to the logbook (as <path>.npz), and only parsed again when the
+    logbook's size or modification time change, or if it was parsed with different arguments.
+    Args:
+        - path (str): to the logbook file
+        - skiplines (int), delimiter (str): see separate_entries
+        - cache (bool): whether to read and write the cache file. If the logbook's directory
+            isn't writable, the logbook is parsed without caching.
+    Returns:
+        - (structured array) with fields 'path', 'Ti', 'Tf', 'ti', 'tf', 'eV', one record per entry.
+            Records index like the tuples of extract_logbook_XRD_metadata, e.g. for create_filename_dictionary"""
+    stat = os.stat(path)
+    key = np.array([stat.st_size, stat.st_mtime_ns, skiplines])
+    cache_file = path + '.npz'
+    if cache and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as cached:
+                if np.array_equal(cached['key'], key) and cached['delimiter'].item() == delimiter:
+                    return cached['metadata']
+        except (OSError, ValueError, KeyError):
+            pass # unreadable or outdated cache; parse again
+
+    paths, columns = [], []
+    with open(path, 'r') as lxf:
+        for entry in iter_entries(itertools.islice(lxf, skiplines, None), delimiter):
+            parsed = parse_XRD_entry(entry)
+            paths.append(parsed[0])
+            columns.append(parsed[1:])
+    paths = np.array(paths, dtype=str)
+    metadata = np.empty(len(paths), dtype=[('path', paths.dtype)] + XRD_METADATA_DTYPE)
+    metadata['path'] = paths
+    values = np.array(columns, dtype=float).reshape(-1, len(XRD_METADATA_DTYPE))
+    for i, (name, _) in enumerate(XRD_METADATA_DTYPE):
+        metadata[name] = values[:, i]
+
+    if cache:
+        tmp_file = cache_file + '.tmp.npz'
+        try:
+            np.savez(tmp_file, metadata=metadata, key=key, delimiter=np.array(delimiter))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+    return metadata
+
+##### Temperature Calibration #####
+
+# calibrations already fitted in this session, keyed by calibration file and read arguments
+_calibration_cache = dict()
+
+class TemperatureCalibration:
+    """Quadratic calibration of the sample temperature against the temperature read by the
+    controller (e.g. of the ROCK gas blower), fitted by least squares as with curve_fit.
+    Optionally holds a continuous log of controller temperatures, sorted by time, to look up
+    calibrated temperatures for many frames at once from their start and end times."""
+
+    def __init__(self, setpoint, sample):
+        """Args:
+            - setpoint (1D array): controller temperatures, x-axis of the calibration
+            - sample (1D array): measured sample temperatures, y-axis of the calibration"""
+        setpoint, sample = np.asarray(setpoint, dtype=float), np.asarray(sample, dtype=float)
+        A = np.vander(setpoint, 3)
+        self.coefficients, _, _, _ = np.linalg.lstsq(A, sample, rcond=None)
+        # same estimate of the covariance as curve_fit (absolute_sigma=False)
+        residual = sample - A @ self.coefficients
+        self.covariance = np.linalg.inv(A.T @ A) * (residual @ residual) / max(len(sample) - 3, 1)
+        self.log_times = None
+        self.log_temperatures = None
+        self._log_integral = None
+
+    @classmethod
+    def from_column_log(cls, cal_file, sample_index=1, setpoint_index=3, skiprows=3):
+        """Fits the calibration to a column log, or returns the calibration already fitted to it
+        if the file hasn't changed since.
+        Args:
+            - cal_file (str): path to the calibration log, see read_column_array
+            - sample_index, setpoint_index (int): columns of the sample and controller temperatures
+            - skiprows (int): header lines of the log
+        Returns:
+            - (TemperatureCalibration)"""
+        stat = os.stat(cal_file)
+        key = (os.path.abspath(cal_file), stat.st_size, stat.st_mtime_ns, sample_index, setpoint_index, skiprows)
+        if key not in _calibration_cache:
+            columns = read_column_array(cal_file, (sample_index, setpoint_index), skiprows, names=('sample', 'setpoint'))
+            _calibration_cache[key] = cls(columns['setpoint'], columns['sample'])
+        return _calibration_cache[key]
+
+    def __call__(self, T):
+        """Args:
+            - T (float or array): controller temperatures
+        Returns:
+            - (float or array) calibrated sample temperatures"""
+        return np.polyval(self.coefficients, np.asarray(T, dtype=float))
+
+    def set_log(self, times, temperatures):
+        """Sets the continuous temperature log used by at and frame_temperatures.
+        Args:
+            - times (1D array): timestamps of the log, in any order (e.g. epoch seconds, as in the logbook)
+            - temperatures (1D array): controller temperatures at those times, calibrated here"""
+        times = np.asarray(times, dtype=float)
+        order = np.argsort(times, kind='stable')
+        self.log_times = times[order]
+        self.log_temperatures = self(np.asarray(temperatures, dtype=float)[order])
+        # running integral of the (linearly interpolated) temperature, for averages over windows
+        steps = 0.5 * (self.log_temperatures[1:] + self.log_temperatures[:-1]) * np.diff(self.log_times)
+        self._log_integral = np.concatenate(([0.], np.cumsum(steps)))
+
+    def at(self, times):
+        """Args:
+            - times (array): e.g. frame start times
+        Returns:
+            - (array) calibrated temperatures interpolated from the log, clamped to its ends"""
+        return np.interp(times, self.log_times, self.log_temperatures)
+
+    def _integral(self, times):
+        log_times, log_temps = self.log_times, self.log_temperatures
+        times = np.clip(times, log_times[0], log_times[-1])
+        i = np.clip(np.searchsorted(log_times, times, side='right') - 1, 0, max(len(log_times) - 2, 0))
+        j = np.minimum(i + 1, len(log_times) - 1)
+        step = log_times[j] - log_times[i]
+        slope = np.divide(log_temps[j] - log_temps[i], step, out=np.zeros_like(step), where=step > 0)
+        dt = times - log_times[i]
+        return self._log_integral[i] + log_temps[i] * dt + 0.5 * slope * dt * dt
+
+    def frame_temperatures(self, t_start, t_end, average=True):
+        """Calibrated sample temperatures of frames from the continuous log (see set_log).
+        Args:
+            - t_start, t_end (arrays): start and end times of each frame's exposure,
+                e.g. the 'ti' and 'tf' columns of read_logbook_XRD_metadata
+            - average (bool): if True, the mean temperature over each exposure window;
+                otherwise the mean of the temperatures at its start and end
+        Returns:
+            - (array) one temperature per frame"""
+        t_start, t_end = np.asarray(t_start, dtype=float), np.asarray(t_end, dtype=float)
+        if not average:
+            return 0.5 * (self.at(t_start) + self.at(t_end))
+        # both ends of all windows are looked up at once
+        integral = self._integral(np.concatenate((t_start, t_end)))
+        lo = np.clip(t_start, self.log_times[0], self.log_times[-1])
+        hi = np.clip(t_end, self.log_times[0], self.log_times[-1])
+        width = hi - lo
+        mean = np.divide(integral[len(t_start):] - integral[:len(t_start)], width,
+                         out=np.zeros_like(width), where=width > 0)
+        # windows of no duration (or entirely outside the log) take the temperature at their start
+        return np.where(width > 0, mean, self.at(t_start))
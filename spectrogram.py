@@ -0,0 +1,181 @@
+"""
+Level-of-detail rendering for large spectrograms, i.e. a matrix plotted against two axes, such as
+XRD intensity vs. (time, 2-theta) in xrd-time-evolution, or differential XAS vs. (time, energy) in
+xas-time-evolution-*. Instead of drawing every cell with pcolor, the matrix is binned into a pyramid
+of coarser levels, and only as many cells as the axes have pixels are drawn for the current view.
+"""
+
+import numpy as np
+
+STATS = ('mean', 'min', 'max')
+
+def _edges(centers):
+    """Cell edges from cell centers, extrapolating half a cell at either end."""
+    centers = np.asarray(centers, dtype=float)
+    if len(centers) == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    mid = 0.5 * (centers[1:] + centers[:-1])
+    return np.concatenate(([2 * centers[0] - mid[0]], mid, [2 * centers[-1] - mid[-1]]))
+
+def _halve(level, axis):
+    """Bins pairs of neighbouring cells of a pyramid level along axis (0 for y, 1 for x).
+    An odd last cell is kept as a bin of its own. The finest level holds only the matrix 'C' and
+    its 'finite' mask, from which each statistic is filled in just for its reduction."""
+    key = 'y_edges' if axis == 0 else 'x_edges'
+    n = len(level[key]) - 1
+    starts = np.arange(0, n, 2)
+    if 'C' in level:
+        C, finite = level['C'], level['finite']
+        ret = {'sum': np.add.reduceat(np.where(finite, C, 0.), starts, axis=axis),
+               'count': np.add.reduceat(finite.astype(np.int64), starts, axis=axis),
+               'min': np.minimum.reduceat(np.where(finite, C, np.inf), starts, axis=axis),
+               'max': np.maximum.reduceat(np.where(finite, C, -np.inf), starts, axis=axis)}
+    else:
+        ret = {'sum': np.add.reduceat(level['sum'], starts, axis=axis),
+               'count': np.add.reduceat(level['count'], starts, axis=axis),
+               'min': np.minimum.reduceat(level['min'], starts, axis=axis),
+               'max': np.maximum.reduceat(level['max'], starts, axis=axis)}
+    ret['x_edges'], ret['y_edges'] = level['x_edges'], level['y_edges']
+    ret[key] = level[key][np.append(starts, n)]
+    return ret
+
+class SpectrogramPyramid:
+    """Multi-resolution pyramid of a (y, x) matrix, as would be passed to pcolor(x, y, C).
+    Level (ly, lx) has cells binned 2**ly times along y and 2**lx times along x, keeping the
+    mean, min, and max of each bin. Levels are computed as they are needed and then kept.
+    Non-finite values (e.g. log(0)) are ignored in the binning."""
+
+    def __init__(self, x, y, C):
+        """Args:
+            - x (1D array): coordinates of the columns of C, monotonic (e.g. 2-theta, or time)
+            - y (1D array): coordinates of the rows of C, monotonic (e.g. time, or energy)
+            - C (2D array): shape (len(y), len(x))"""
+        C = np.asarray(C, dtype=float)
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if C.shape != (len(y), len(x)):
+            raise ValueError(f"C has shape {C.shape}, expected {(len(y), len(x))}")
+        # work with ascending coordinates, so views can be found with searchsorted
+        if len(x) > 1 and x[-1] < x[0]:
+            x, C = x[::-1], C[:, ::-1]
+        if len(y) > 1 and y[-1] < y[0]:
+            y, C = y[::-1], C[::-1]
+        # the finest level is the matrix itself, binned statistics start one level up
+        base = {'C': C, 'finite': np.isfinite(C), 'x_edges': _edges(x), 'y_edges': _edges(y)}
+        self.shape = C.shape
+        # number of halvings until a single cell remains along each axis
+        self.max_level = (int(np.ceil(np.log2(max(C.shape[0], 1)))), int(np.ceil(np.log2(max(C.shape[1], 1)))))
+        self._levels = {(0, 0): base}
+        self._artists = dict()
+
+    def level(self, ly, lx):
+        """Returns the level (ly, lx), computing it (and the levels it is binned from) if needed.
+        Returns:
+            - (dict) with 'sum', 'count', 'min', 'max' matrices (for level (0, 0), 'C' and its
+                'finite' mask instead), and 'x_edges', 'y_edges'"""
+        ly, lx = min(ly, self.max_level[0]), min(lx, self.max_level[1])
+        if (ly, lx) not in self._levels:
+            if lx > 0:
+                self._levels[(ly, lx)] = _halve(self.level(ly, lx - 1), axis=1)
+            else:
+                self._levels[(ly, lx)] = _halve(self.level(ly - 1, lx), axis=0)
+        return self._levels[(ly, lx)]
+
+    @staticmethod
+    def _stat(level, stat, rows, cols):
+        if stat not in STATS:
+            raise ValueError(f"stat must be one of {STATS}")
+        if 'C' in level:
+            # a single cell has the same mean, min and max
+            return np.where(level['finite'][rows, cols], level['C'][rows, cols], np.nan)
+        count = level['count'][rows, cols]
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = level['sum'][rows, cols] / count
+        else:
+            values = level[stat][rows, cols].astype(float)
+        values[count == 0] = np.nan
+        return values
+
+    @staticmethod
+    def _visible(edges, lim):
+        """Slice of the cells between edges that overlap the interval lim."""
+        lo, hi = min(lim), max(lim)
+        start = max(np.searchsorted(edges, lo, side='right') - 1, 0)
+        stop = min(np.searchsorted(edges, hi, side='left'), len(edges) - 1)
+        return slice(start, max(stop, start + 1))
+
+    def view(self, xlim=None, ylim=None, max_cells=(1000, 1000), stat='mean'):
+        """Selects the finest level that has at most max_cells visible cells along each axis.
+        Args:
+            - xlim, ylim (tuple): visible extent; None for the full extent
+            - max_cells (tuple of int): (along x, along y), e.g. the size of the axes in pixels
+            - stat (str): 'mean', 'min', or 'max' of the binned cells
+        Returns:
+            - (1D array) x edges, (1D array) y edges, (2D array) values of the visible cells,
+                i.e. the arguments of pcolormesh"""
+        base = self._levels[(0, 0)]
+        levels = []
+        for edges, lim, max_n in ((base['y_edges'], ylim, max_cells[1]), (base['x_edges'], xlim, max_cells[0])):
+            visible = self._visible(edges, (edges[0], edges[-1]) if lim is None else lim)
+            n = visible.stop - visible.start
+            levels.append(max(0, int(np.ceil(np.log2(n / max(max_n, 1))))) if n > max_n else 0)
+        level = self.level(*levels)
+        rows = self._visible(level['y_edges'], (base['y_edges'][0], base['y_edges'][-1]) if ylim is None else ylim)
+        cols = self._visible(level['x_edges'], (base['x_edges'][0], base['x_edges'][-1]) if xlim is None else xlim)
+        x_edges = level['x_edges'][cols.start:cols.stop + 1]
+        y_edges = level['y_edges'][rows.start:rows.stop + 1]
+        return x_edges, y_edges, self._stat(level, stat, rows, cols)
+
+    def render(self, ax, stat='mean', max_cells=None, dpi=None, **kwargs):
+        """Draws the spectrogram on a matplotlib axes, and redraws it at the appropriate level
+        whenever the view is zoomed or panned (e.g. with an interactive backend like nbagg).
+        Args:
+            - ax (matplotlib Axes)
+            - stat (str): see view
+            - max_cells (tuple of int): see view; if None, one cell per pixel of the axes
+            - dpi (float): resolution the figure will be saved at (as passed to savefig), if
+                max_cells is None; the mesh is otherwise sized for the screen, at the figure's dpi
+            - kwargs: passed to ax.pcolormesh, e.g. cmap. vmin and vmax default to the
+                range of the whole matrix so that colors don't change with the view
+        Returns:
+            - (matplotlib QuadMesh) the mesh initially drawn, e.g. for plt.colorbar"""
+        # the coarsest level is a single cell, holding the range of the whole matrix
+        coarsest = self.level(*self.max_level)
+        everything = slice(None), slice(None)
+        low, high = self._stat(coarsest, 'min', *everything), self._stat(coarsest, 'max', *everything)
+        if np.isfinite(low).any():
+            kwargs.setdefault('vmin', float(np.nanmin(low)))
+            kwargs.setdefault('vmax', float(np.nanmax(high)))
+        base = self.level(0, 0)
+        state = {'busy': False}
+
+        def draw(xlim=None, ylim=None):
+            if max_cells is None:
+                scale = 1. if dpi is None else dpi / ax.figure.dpi
+                cells = (int(ax.bbox.width * scale), int(ax.bbox.height * scale))
+            else:
+                cells = max_cells
+            x_edges, y_edges, values = self.view(xlim, ylim, cells, stat)
+            old = self._artists.get(id(ax))
+            if old is not None:
+                old.remove()
+            mesh = ax.pcolormesh(x_edges, y_edges, values, shading='flat', **kwargs)
+            self._artists[id(ax)] = mesh
+            return mesh
+
+        def on_change(changed_ax):
+            if state['busy']:
+                return
+            state['busy'] = True
+            try:
+                draw(changed_ax.get_xlim(), changed_ax.get_ylim())
+            finally:
+                state['busy'] = False
+
+        mesh = draw()
+        ax.set_xlim(base['x_edges'][0], base['x_edges'][-1])
+        ax.set_ylim(base['y_edges'][0], base['y_edges'][-1])
+        ax.autoscale(False)
+        ax.callbacks.connect('xlim_changed', on_change)
+        ax.callbacks.connect('ylim_changed', on_change)
+        return mesh
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import xasprocess as xap
+
+ENERGIES = np.linspace(-50, 400, 600)
+WAVENUMBERS = np.sqrt(np.clip(ENERGIES, 0, None) * 0.2625)
+WINDOWS = {'E': (ENERGIES, (0, 300)), 'k': (WAVENUMBERS, (3, 8))}
+
+def noisy_series(seed, n=300, noise=0.01):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=len(ENERGIES)) + noise * rng.normal(size=(n, len(ENERGIES)))
+
+def test_cusum_threshold_matches_siegmund():
+    # h = 5 with k = 0.5 is the textbook CUSUM with an in-control ARL of about 930 (Siegmund)
+    assert xap.cusum_threshold(930., 0.5) == pytest.approx(5., abs=0.01)
+
+def test_differences_match_total_abs_diffs():
+    spectra = noisy_series(0, n=20)
+    diffs = xap.ChangeDetector(WINDOWS).run(spectra)
+    mask = (ENERGIES > 0) & (ENERGIES < 300)
+    expected = np.abs(np.diff(spectra, axis=0) * mask).sum(axis=1)
+    np.testing.assert_allclose(diffs[:, 0], expected, rtol=1e-12)
+
+def test_no_alarms_on_noise():
+    alarms = 0
+    for seed in range(30):
+        detector = xap.ChangeDetector(WINDOWS)
+        detector.run(noisy_series(seed))
+        alarms += len(detector.changes)
+    # 30 series of 300 spectra in 2 windows, with false alarms intended once per 10^4 spectra per window
+    assert alarms <= 3
+
+def test_step_change_is_flagged():
+    for seed in range(10):
+        spectra = noisy_series(seed)
+        spectra[150:] += 0.05 * np.sin(ENERGIES / 10)
+        detector = xap.ChangeDetector(WINDOWS)
+        detector.run(spectra)
+        assert (150, 'E') in detector.changes
+
+def test_step_after_constant_series_is_flagged():
+    # a flat baseline has no spread: the CUSUM must stay finite rather than turn into nan
+    spectra = np.ones((100, len(ENERGIES)))
+    spectra[60:] += 0.05
+    detector = xap.ChangeDetector(WINDOWS)
+    detector.run(spectra)
+    assert not np.isnan(detector.cusum).any()
+    assert (60, 'E') in detector.changes
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(ValueError):
+        xap.ChangeDetector(WINDOWS, warmup=1)
+    with pytest.raises(ValueError):
+        xap.ChangeDetector({'E': (ENERGIES, (500, 600))})
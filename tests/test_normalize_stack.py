@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+import xasprocess as xap
+
+ENERGY = np.arange(8200., 8800., 0.5)
+E0 = 8333.
+
+def edge_spectra(n=5, seed=0):
+    """Arctangent edges on a linear pre-edge, with a damped oscillation above the edge."""
+    rng = np.random.default_rng(seed)
+    step = 1. + 0.2 * rng.random((n, 1))
+    above = np.clip(ENERGY - E0, 0, None)
+    oscillation = 0.02 * np.sin(above / 15.) * np.exp(-above / 200.)
+    edge = 0.5 + np.arctan((ENERGY - E0) / 2.) / np.pi
+    return 0.1 + 2e-4 * (ENERGY - 8200.) + step * (edge + oscillation)
+
+def test_step_of_flat_post_edge():
+    mu = 0.3 + 1e-3 * (ENERGY - 8200.) + np.where(ENERGY >= E0, 1.5, 0.)
+    result = xap.normalize_stack(ENERGY, mu, e0=E0)
+    assert result['edge_step'][0] == pytest.approx(1.5, rel=1e-9)
+    np.testing.assert_allclose(result['norm'][0], np.where(ENERGY >= E0, 1., 0.), atol=1e-9)
+
+def test_agrees_with_larch():
+    pytest.importorskip('larch')
+    mu = edge_spectra()
+    result = xap.normalize_stack(ENERGY, mu)
+    worst = xap.compare_with_larch(ENERGY, mu, result, rows=range(len(mu)))
+    # E0 is found differently from larch's find_e0 (see find_e0_stack): within a couple of grid steps
+    assert worst['e0'] <= 1.
+    # given the same E0, the fits are the same up to rounding
+    assert worst['edge_step'] <= 1e-8
+    assert worst['norm'] <= 1e-8
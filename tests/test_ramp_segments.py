@@ -0,0 +1,17 @@
+import numpy as np
+
+import xasprocess as xap
+
+def test_segments_of_ramp():
+    temperature = np.concatenate((np.linspace(25, 900, 50), np.full(20, 900.), np.linspace(900, 25, 50)))
+    labels = xap.ramp_labels(temperature)
+    segments = xap.ramp_segments(labels, temperature)
+    assert segments['start'][0] == 0 and segments['stop'][-1] == len(temperature)
+    np.testing.assert_array_equal(segments['start'][1:], segments['stop'][:-1])
+    for segment in segments:
+        assert np.all(labels[segment['start']:segment['stop']] == segment['label'])
+
+def test_empty_series_has_no_segments():
+    segments = xap.ramp_segments(np.zeros(0, dtype=np.int8), np.zeros(0))
+    assert segments.dtype == xap.SEGMENT_DTYPE and len(segments) == 0
+    assert len(xap.select_ramp(segments, 'cooling', np.zeros(0))) == 0
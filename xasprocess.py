@@ -0,0 +1,878 @@
+"""
+These are functions for processing batches of XAS spectra, as used by the xas-time-evolution-*
+and xas-pca-* notebooks: normalization and background removal with Larch, resampling onto common
+grids, and operations on stacks of spectra sharing one energy (or wavenumber) axis.
+"""
+
+import os
+import time
+import json
+import hashlib
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse
+from scipy.signal import savgol_filter
+
+##### Batch Larch Normalization #####
+
+# larch normalization parameters used throughout (eV w.r.t. auto-determined E0)
+PRE_EDGE_PARAMS = dict(pre1=-105, pre2=-38, norm1=150, norm2=300, nnorm=0)
+
+def larch_normalize(energy, mu, pre_edge_kws=PRE_EDGE_PARAMS, autobk_kws=None):
+    """Normalizes one spectrum as _larchgroup_init does in the notebooks.
+    Args:
+        - energy (1D array): in eV, or in keV if all values are below 100
+        - mu (1D array): absorption
+        - pre_edge_kws (dict): passed to larch pre_edge; {} for larch's defaults
+        - autobk_kws (dict): passed to larch autobk; {} for larch's defaults, None to skip autobk
+    Returns:
+        - (dict) 'energy', 'mu' (sorted, energy in eV), 'norm', 'e0', 'edge_step',
+            and 'k', 'chi' if autobk was run"""
+    # imported here, so that the rest of the module can be used without larch installed
+    from larch import Group
+    from larch.xafs import sort_xafs, pre_edge, autobk
+    energy, mu = np.asarray(energy, dtype=float), np.asarray(mu, dtype=float)
+    g = Group()
+    g.is_frozen = False
+    g.datatype = 'xas'
+    g.xdat = g.energy = 1000. * energy if max(energy) < 100 else energy
+    g.ydat = g.mu = mu
+    g.yerr = 1.
+    sort_xafs(g, overwrite=True, fix_repeats=True)
+    pre_edge(g, **pre_edge_kws)
+    ret = {'energy': g.energy, 'mu': g.mu, 'norm': g.norm, 'e0': g.e0, 'edge_step': g.edge_step}
+    if autobk_kws is not None:
+        autobk(g, **autobk_kws)
+        ret['k'], ret['chi'] = g.k, g.chi
+    return ret
+
+def _normalize_job(job):
+    """Runs larch_normalize in a worker, returning the error instead of raising it so that one
+    bad spectrum doesn't lose the results of the others."""
+    energy, mu, pre_edge_kws, autobk_kws = job
+    try:
+        return larch_normalize(energy, mu, pre_edge_kws, autobk_kws)
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+
+def normalize_batch(spectra, pre_edge_kws=PRE_EDGE_PARAMS, autobk_kws=None, workers=None, verbose=True):
+    """Normalizes (and optionally removes the background of) many spectra over a process pool.
+    Args:
+        - spectra (iterable): of (energy, mu) pairs of 1D arrays, e.g. the first two rows of
+            the arrays returned by xasread.load_rock_normalized
+        - pre_edge_kws, autobk_kws (dict): the same for all spectra, see larch_normalize
+        - workers (int): number of processes; if None, one per CPU
+        - verbose (bool): print throughput and the number of spectra that failed
+    Returns:
+        - (list of dict) in the same order as spectra, see larch_normalize. Spectra that failed
+            have a dict with only an 'error' message instead."""
+    jobs = [(energy, mu, pre_edge_kws, autobk_kws) for energy, mu in spectra]
+    if workers is None:
+        workers = os.cpu_count()
+    # batch the jobs sent to each process to limit inter-process overhead
+    chunksize = max(1, len(jobs) // (4 * workers))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_normalize_job, jobs, chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+    if verbose:
+        failed = sum('error' in result for result in results)
+        print(f"Normalized {len(results) - failed} spectra in {elapsed:.1f} s on {workers} workers"
+              + (f", {failed} failed" if failed > 0 else ""))
+    return results
+
+##### Stack Normalization #####
+
+def find_e0_stack(energy, mu, nflat=3):
+    """E0 of each spectrum of a stack, as the energy of its maximum derivative (averaged over 3 points).
+    This is intentionally simpler than larch's find_e0, which smooths and checks the derivative in
+    its own way, so the two can differ by a grid step or so; compare_with_larch reports by how much.
+    Args:
+        - energy (1D array): shared energy grid (ascending), shape (m,)
+        - mu (2D array): absorption, shape (n, m)
+        - nflat (int): points at either end of the grid that can't be the edge
+    Returns:
+        - (np.ndarray) E0 of each spectrum, shape (n,)"""
+    dmu = np.gradient(mu, energy, axis=1)
+    # average over neighbours, so that a single noisy point can't be taken for the edge
+    dmu[:, 1:-1] = (dmu[:, :-2] + dmu[:, 1:-1] + dmu[:, 2:]) / 3.
+    dmu[:, :nflat] = dmu[:, -nflat:] = -np.inf
+    dmu[~np.isfinite(dmu)] = -np.inf
+    return energy[np.argmax(dmu, axis=1)]
+
+def _window_fits(x, y, lo, hi, degree):
+    """Least-squares polynomials fitted to each row of y over its own window of x, all at once.
+    Args:
+        - x (1D array): shared abscissa, shape (m,), already centered and scaled
+        - y (2D array): shape (n, m)
+        - lo, hi (1D int arrays): each row's window is x[lo:hi]
+        - degree (int): of the polynomials
+    Returns:
+        - (np.ndarray) coefficients, shape (n, degree + 1), lowest order first"""
+    index = np.arange(len(x))
+    weights = ((index >= lo[:, None]) & (index < hi[:, None])).astype(float)
+    powers = x[:, None] ** np.arange(2 * degree + 1) # (m, 2 * degree + 1)
+    moments = weights @ powers # sums of x^k over each window
+    rhs = (weights * y) @ powers[:, :degree + 1]
+    orders = np.arange(degree + 1)
+    lhs = moments[:, orders[:, None] + orders[None, :]] # (n, degree + 1, degree + 1)
+    return np.linalg.solve(lhs, rhs[..., None])[..., 0]
+
+def normalize_stack(energy, mu, e0=None, pre1=PRE_EDGE_PARAMS['pre1'], pre2=PRE_EDGE_PARAMS['pre2'],
+                    norm1=PRE_EDGE_PARAMS['norm1'], norm2=PRE_EDGE_PARAMS['norm2'], nnorm=PRE_EDGE_PARAMS['nnorm']):
+    """Pre-edge subtraction and normalization of a stack of spectra sharing one energy grid,
+    following larch's pre_edge: a line fitted between e0+pre1 and e0+pre2 is subtracted, and the
+    result divided by the edge step, the value at e0 of a polynomial fitted between e0+norm1 and e0+norm2.
+    Every spectrum is fitted at once, instead of calling pre_edge once per spectrum.
+    Args:
+        - energy (1D array): shared energy grid in eV (ascending), shape (m,), e.g. from interpolate_xas_groups
+        - mu (2D array): absorption, shape (n, m)
+        - e0 (float or 1D array): edge energies; if None, found with find_e0_stack
+        - pre1, pre2, norm1, norm2 (float): window bounds (eV w.r.t. e0), as for larch pre_edge
+        - nnorm (int): degree of the post-edge polynomial
+    Returns:
+        - (dict) 'norm' (n, m), 'e0' (n,), 'edge_step' (n,), and 'pre_edge' (n, m) lines"""
+    energy = np.asarray(energy, dtype=float)
+    mu = np.atleast_2d(np.asarray(mu, dtype=float))
+    n, m = mu.shape
+    e0 = find_e0_stack(energy, mu) if e0 is None else np.broadcast_to(np.asarray(e0, dtype=float), (n,))
+    # fit in centered and scaled energies, to keep the normal equations well conditioned
+    center, scale = 0.5 * (energy[0] + energy[-1]), max(0.5 * (energy[-1] - energy[0]), 1e-12)
+    x = (energy - center) / scale
+
+    def window(start, stop):
+        # as larch's index_of and index_nearest, with at least 2 points in each window
+        lo = np.clip(np.searchsorted(energy, e0 + start, side='right') - 1, 0, m - 2)
+        hi = np.abs(energy[None, :] - (e0 + stop)[:, None]).argmin(axis=1)
+        hi = np.clip(np.maximum(hi, lo + 2), 0, m)
+        return lo, hi
+
+    lo, hi = window(pre1, pre2)
+    pre_coefs = _window_fits(x, mu, lo, hi, 1)
+    pre_edge = pre_coefs[:, :1] + pre_coefs[:, 1:] * x[None, :]
+    presub = mu - pre_edge
+
+    lo, hi = window(norm1, norm2)
+    post_coefs = _window_fits(x, presub, lo, hi, nnorm)
+    ie0 = np.abs(energy[None, :] - e0[:, None]).argmin(axis=1)
+    edge_step = np.polynomial.polynomial.polyval(x[ie0], post_coefs.T, tensor=False)
+    edge_step = np.maximum(np.abs(edge_step), 1e-12)
+    return {'norm': presub / edge_step[:, None], 'e0': e0, 'edge_step': edge_step, 'pre_edge': pre_edge}
+
+def compare_with_larch(energy, mu, result, rows=None, **pre_edge_kws):
+    """Checks normalize_stack against larch pre_edge on some spectra of the stack: E0 against the
+    one larch finds by itself, and the edge step and normalization given the same E0.
+    Args:
+        - energy, mu: as passed to normalize_stack
+        - result (dict): as returned by normalize_stack
+        - rows (iterable of int): spectra to check; by default, 10 spread over the stack
+        - pre_edge_kws: the parameters passed to normalize_stack, if not the defaults
+    Returns:
+        - (dict) largest absolute differences over the rows checked, of 'e0' (in eV), 'edge_step', and 'norm'"""
+    mu = np.atleast_2d(mu)
+    if rows is None:
+        rows = np.unique(np.linspace(0, len(mu) - 1, 10).astype(int))
+    kws = dict(PRE_EDGE_PARAMS, **pre_edge_kws)
+    worst = {'e0': 0., 'edge_step': 0., 'norm': 0.}
+    for i in rows:
+        found = larch_normalize(energy, mu[i], kws)
+        worst['e0'] = max(worst['e0'], abs(float(found['e0']) - float(result['e0'][i])))
+        same_e0 = larch_normalize(energy, mu[i], dict(kws, e0=result['e0'][i]))
+        worst['edge_step'] = max(worst['edge_step'], abs(float(same_e0['edge_step']) - float(result['edge_step'][i])))
+        worst['norm'] = max(worst['norm'], float(np.max(np.abs(same_e0['norm'] - result['norm'][i]))))
+    return worst
+
+##### Resampling #####
+
+MAX_INTERPOLATORS = 64 # interpolation matrices kept in memory
+_interpolators = OrderedDict()
+
+# same constants as E_to_k in the notebooks
+HBAR = 1.055e-34 # J * s
+M_E = 9.1e-31 # kg
+JEV = 1.602e-19 # J per eV
+
+def k_to_energy(k, e0):
+    """Inverse of E_to_k in the notebooks, e.g. to resample onto a chosen grid of wavenumbers.
+    Args:
+        - k (array-like): photoelectron wavenumbers (in 1/A)
+        - e0 (float): energy of absorption edge (in eV)
+    Returns:
+        - (array-like) energies (in eV)"""
+    return e0 + (np.asarray(k) * 1e10 * HBAR)**2 / (2 * M_E * JEV)
+
+def interpolation_matrix(source, target):
+    """Args:
+        - source (1D array): ascending grid of the signals, shape (m,)
+        - target (1D array): grid to interpolate to, shape (t,)
+    Returns:
+        - (scipy.sparse.csr_matrix) M of shape (t, m), such that M @ y equals np.interp(target, source, y),
+            including its clamping to the end values outside of source"""
+    source, target = np.asarray(source, dtype=float), np.asarray(target, dtype=float)
+    m = len(source)
+    if m == 1:
+        return scipy.sparse.csr_matrix((np.ones(len(target)), (np.arange(len(target)), np.zeros(len(target), dtype=int))), shape=(len(target), 1))
+    j = np.clip(np.searchsorted(source, target, side='right') - 1, 0, m - 2)
+    step = source[j + 1] - source[j]
+    w = np.divide(target - source[j], step, out=np.zeros_like(target), where=step > 0)
+    w = np.clip(w, 0., 1.)
+    rows = np.repeat(np.arange(len(target)), 2)
+    cols = np.stack((j, j + 1), axis=1).ravel()
+    data = np.stack((1. - w, w), axis=1).ravel()
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(len(target), m))
+
+def _grid_key(grid):
+    grid = np.ascontiguousarray(grid, dtype=float)
+    return (len(grid), hashlib.sha1(grid.tobytes()).hexdigest())
+
+def cached_interpolation_matrix(source, target):
+    """interpolation_matrix, built once for each (source, target) pair and then kept,
+    up to MAX_INTERPOLATORS of the most recently used."""
+    key = (_grid_key(source), _grid_key(target))
+    if key in _interpolators:
+        _interpolators.move_to_end(key)
+    else:
+        _interpolators[key] = interpolation_matrix(source, target)
+        if len(_interpolators) > MAX_INTERPOLATORS:
+            _interpolators.popitem(last=False)
+    return _interpolators[key]
+
+def resample(sources, signals, targets=None, verbose=False):
+    """Interpolates signals onto one grid. Signals sharing a source grid (e.g. all scans with the same
+    monochromator trajectory) are resampled together, with one sparse matrix product.
+    Args:
+        - sources (list of 1D array, or 1D array): grids (energies or wavenumbers) of each signal,
+            or a single grid shared by all signals
+        - signals (list of 1D array, or 2D array): one signal per grid
+        - targets (1D array): grid to resample onto, e.g. a fixed energy grid, or k_to_energy of a
+            fixed k grid, so that stacks from different runs are comparable. If None, uses the
+            SHORTEST of sources, as interpolate_xas does.
+        - verbose (bool): print the grids' lengths
+    Returns:
+        - (1D array) targets
+        - (2D array) resampled signals, shape (number of signals, len(targets))"""
+    if isinstance(sources, np.ndarray) and sources.ndim == 1:
+        sources = [sources] * len(signals)
+    if targets is None:
+        lengths = [len(source) for source in sources]
+        targets = sources[int(np.argmin(lengths))]
+        if verbose:
+            print(f"Mapping to {len(targets)} points from spectra up to {np.max(lengths)} long")
+    targets = np.asarray(targets, dtype=float)
+    # group the signals by grid; grids are compared by value, since each scan usually has its own copy
+    groups = dict()
+    for i, source in enumerate(sources):
+        source = np.asarray(source, dtype=float)
+        candidates = groups.setdefault((len(source), source[0], source[-1]), [])
+        for grid, rows in candidates:
+            if grid is source or np.array_equal(grid, source):
+                rows.append(i)
+                break
+        else:
+            candidates.append((source, [i]))
+    out = np.empty((len(signals), len(targets)))
+    for candidates in groups.values():
+        for source, rows in candidates:
+            stack = signals[rows] if isinstance(signals, np.ndarray) else np.array([signals[i] for i in rows], dtype=float)
+            out[rows] = stack @ cached_interpolation_matrix(source, targets).T
+    return targets, out
+
+##### Normalized Spectra Cache #####
+
+NORMALIZED_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'heo-xas-xrd', 'normalized')
+MAX_CACHE_BYTES = 2 * 1024**3 # least recently used entries are evicted beyond this
+CACHED_ARRAYS = ('energy', 'mu', 'norm', 'k', 'chi')
+SOURCE_HASHES_FILENAME = 'source_hashes.json' # {absolute path: [size, mtime_ns, hex digest]}
+CACHE_VERSION = 1 # increment when the content or layout of entries changes
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of a file's contents, e.g. a BM23 HDF5 file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class NormalizedCache:
+    """On-disk cache of larch_normalize results, one uncompressed .npz file per spectrum, named by
+    the hash of what determines the result: the contents of the source file, the scan within it,
+    how (energy, mu) were read from it (the reader, e.g. which columns), the normalization
+    parameters, the larch version, and CACHE_VERSION. Entries don't go stale as long as the reader passed to key identifies how the spectra
+    were read, since any other change of inputs changes the name. Reading an entry marks it as recently
+    used, and the least recently used entries are removed once the cache exceeds max_bytes.
+    File digests are kept in the cache directory with the size and modification time of each file,
+    so that files are only hashed again when they change."""
+
+    def __init__(self, cache_dir=NORMALIZED_CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        """Args:
+            - cache_dir (str): directory in which entries are saved
+            - max_bytes (int): size above which entries are evicted"""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hashes_path = os.path.join(cache_dir, SOURCE_HASHES_FILENAME)
+        try:
+            with open(self._hashes_path, 'r') as f:
+                self._hashes = json.load(f)
+        except (OSError, ValueError): # none yet, or unreadable
+            self._hashes = dict()
+        self._hashes_changed = False
+        self._larch_version = None # looked up on first use, so that larch is only imported when needed
+
+    def source_hash(self, path):
+        """Args:
+            - path (str): e.g. a BM23 HDF5 file, or a ROCK normalized text file
+        Returns:
+            - (str) SHA-256 hex digest of its contents, hashed again only if its size or modification time changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self._hashes.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        self._hashes[path] = [stat.st_size, stat.st_mtime_ns, file_digest(path)]
+        self._hashes_changed = True
+        return self._hashes[path][2]
+
+    def save_hashes(self):
+        """Writes the file digests computed since the cache was opened to the cache directory."""
+        if not self._hashes_changed:
+            return
+        tmp_path = f"{self._hashes_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._hashes, f)
+        os.replace(tmp_path, self._hashes_path)
+        self._hashes_changed = False
+
+    def key(self, path, scan, reader, pre_edge_kws=PRE_EDGE_PARAMS, autobk_kws=None):
+        """Args:
+            - path (str): source file of the spectrum
+            - scan: identifies the spectrum within the file (e.g. a BM23 scan number); None for one spectrum per file
+            - reader (str): identifies how (energy, mu) are read from the file, e.g. the function and
+                the column labels; reading the same file differently must give a different reader
+            - pre_edge_kws, autobk_kws (dict): see larch_normalize
+        Returns:
+            - (str) hex digest identifying the normalized spectrum"""
+        if self._larch_version is None:
+            import larch
+            self._larch_version = larch.__version__
+        autobk_items = None if autobk_kws is None else sorted(autobk_kws.items())
+        sha = hashlib.sha256(self.source_hash(path).encode())
+        sha.update(repr((str(scan), str(reader), sorted(pre_edge_kws.items()), autobk_items,
+                         self._larch_version, CACHE_VERSION)).encode())
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """Returns:
+            - (dict) as returned by larch_normalize, or None if key is not cached"""
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                ret = {name: f[name] for name in f.files}
+        except (OSError, ValueError, zipfile.BadZipFile): # absent, removed by another session, or corrupt
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except FileNotFoundError:
+            pass
+        ret['e0'], ret['edge_step'] = float(ret['e0']), float(ret['edge_step'])
+        return ret
+
+    def put(self, key, result):
+        """Saves a result of larch_normalize; results with an 'error' are not saved."""
+        if 'error' in result:
+            return
+        arrays = {name: np.asarray(result[name], dtype=float) for name in CACHED_ARRAYS if name in result}
+        arrays['e0'], arrays['edge_step'] = np.float64(result['e0']), np.float64(result['edge_step'])
+        # write to a temporary file first, so that interrupted or concurrent writes never leave partial entries
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self._path(key))
+
+    def size(self):
+        """Returns:
+            - (int) total size of the entries in bytes"""
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npz'))
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is at most max_bytes.
+        Returns:
+            - (int) number of entries removed"""
+        entries = [(entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+                   for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npz')]
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+def normalize_cached(sources, spectra, reader, pre_edge_kws=PRE_EDGE_PARAMS, autobk_kws=None, cache=None,
+                     workers=None, verbose=True):
+    """normalize_batch, skipping every spectrum already normalized with the same parameters
+    in this or an earlier session.
+    Args:
+        - sources (list): for each spectrum, its source file path, or a (path, scan) tuple
+            if a file holds several spectra
+        - spectra (list, or callable): (energy, mu) pairs in the same order as sources, or a function
+            taking the list of indices of the spectra not in the cache and returning their (energy, mu)
+            pairs, so that only those are read from the source files
+        - reader (str): identifies how spectra reads (energy, mu) from the source files, e.g.
+            'read_ascii energy_cenc, mu_fluo'; see NormalizedCache.key
+        - pre_edge_kws, autobk_kws (dict): see larch_normalize
+        - cache (NormalizedCache): if None, one in NORMALIZED_CACHE_DIR
+        - workers (int), verbose (bool): see normalize_batch
+    Returns:
+        - (list of dict) as returned by normalize_batch"""
+    if cache is None:
+        cache = NormalizedCache()
+    sources = [source if isinstance(source, tuple) else (source, None) for source in sources]
+    keys = [cache.key(path, scan, reader, pre_edge_kws, autobk_kws) for path, scan in sources]
+    cache.save_hashes()
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if verbose:
+        print(f"{len(keys) - len(missing)} of {len(keys)} normalized spectra found in the cache")
+    if missing:
+        todo = spectra(missing) if callable(spectra) else [spectra[i] for i in missing]
+        for i, result in zip(missing, normalize_batch(todo, pre_edge_kws, autobk_kws, workers, verbose)):
+            results[i] = result
+            cache.put(keys[i], result)
+        cache.evict()
+    return results
+
+##### Spectra Stacks #####
+
+class SpectraStack:
+    """Spectra sharing one axis (energy, or wavenumber), held as a single (n, m) matrix together with
+    one array per kind of metadata, instead of a list of Larch Groups or tuples that each hold their
+    own copy of the axis. Indexing selects spectra as numpy does: stack[10:50] and stack[::2] are
+    views of the same matrix, while boolean masks and index arrays (e.g. stack[stack.temperature > 700])
+    give copies of only the selected rows. Either way, the axis is shared rather than copied."""
+
+    __slots__ = ('axis', 'data', 'time', 'temperature', 'scan', 'source')
+    METADATA = ('time', 'temperature', 'scan', 'source')
+
+    def __init__(self, axis, data, time=None, temperature=None, scan=None, source=None, dtype=None):
+        """Args:
+            - axis (1D array): shared by all spectra, shape (m,)
+            - data (2D array-like): spectra, shape (n, m); not copied if already an array of dtype
+            - time, temperature (1D array-like): per spectrum, NaN if None
+            - scan (1D array-like of int): scan IDs, -1 if None
+            - source (1D array-like of str): source files, '' if None
+            - dtype: of data, e.g. np.float32 to halve its size; if None, that of data (or float)"""
+        self.axis = np.asarray(axis, dtype=float)
+        self.data = np.asarray(data, dtype=float if dtype is None and not isinstance(data, np.ndarray) else dtype)
+        if self.data.ndim != 2 or self.data.shape[1] != len(self.axis):
+            raise ValueError(f"data has shape {self.data.shape}, expected (n, {len(self.axis)})")
+        n = len(self.data)
+        self.time = np.full(n, np.nan) if time is None else np.asarray(time, dtype=float)
+        self.temperature = np.full(n, np.nan) if temperature is None else np.asarray(temperature, dtype=float)
+        self.scan = np.full(n, -1) if scan is None else np.asarray(scan, dtype=int)
+        self.source = np.full(n, '') if source is None else np.asarray(source, dtype=str)
+        for name in self.METADATA:
+            if getattr(self, name).shape != (n,):
+                raise ValueError(f"{name} has shape {getattr(self, name).shape}, expected ({n},)")
+
+    @classmethod
+    def from_groups(cls, groups, attr='norm', dtype=None):
+        """Stacks Larch Groups that were interpolated onto one energy grid (e.g. by interpolate_xas_groups).
+        Args:
+            - groups (list of Larch Group): with energy, attr, and optionally time, temperature, scan, path
+            - attr (str): the signal to stack, e.g. 'norm' or 'mu'
+            - dtype: see __init__
+        Returns:
+            - (SpectraStack)"""
+        axis = groups[0].energy
+        for g in groups:
+            if g.energy is not axis and not np.array_equal(g.energy, axis):
+                raise ValueError(f"{getattr(g, 'name', g)} is not on the same energy grid as the first group")
+        return cls(axis, np.array([getattr(g, attr) for g in groups], dtype=dtype),
+                   time=[getattr(g, 'time', np.nan) for g in groups],
+                   temperature=[getattr(g, 'temperature', np.nan) for g in groups],
+                   scan=[getattr(g, 'scan', -1) for g in groups],
+                   source=[getattr(g, 'path', '') for g in groups])
+
+    @classmethod
+    def from_spectra(cls, axes, signals, targets=None, dtype=None, **metadata):
+        """Stacks spectra with their own axes, resampling them onto one (see resample) if they differ.
+        Args:
+            - axes (list of 1D array, or 1D array): see sources of resample
+            - signals (list of 1D array, or 2D array): one per axis
+            - targets (1D array): see resample
+            - dtype, metadata (time, temperature, scan, source): see __init__
+        Returns:
+            - (SpectraStack)"""
+        targets, data = resample(axes, signals, targets)
+        return cls(targets, data if dtype is None else data.astype(dtype), **metadata)
+
+    def _rows(self, data, key):
+        """A stack of the rows key of every array, with data (rows key of self.data, or a new matrix)."""
+        ret = object.__new__(type(self))
+        ret.axis, ret.data = self.axis, data
+        for name in self.METADATA:
+            setattr(ret, name, getattr(self, name)[key])
+        return ret
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        """Args:
+            - key (int, slice, boolean mask, or array of int): spectra to select
+        Returns:
+            - (SpectraStack) the selected spectra, a view for ints and slices"""
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key + 1 if key != -1 else None)
+        return self._rows(self.data[key], key)
+
+    def __repr__(self):
+        return f"SpectraStack({len(self)} spectra x {len(self.axis)} points, {self.data.dtype})"
+
+    @property
+    def nbytes(self):
+        """Memory taken by the matrix, axis, and metadata."""
+        return self.axis.nbytes + self.data.nbytes + sum(getattr(self, name).nbytes for name in self.METADATA)
+
+    def where(self, **ranges):
+        """Boolean mask of the spectra within open intervals of metadata.
+        Args:
+            - ranges: e.g. temperature=(700, 910), time=(t0, None); None for no bound
+        Returns:
+            - (1D bool array) shape (n,), e.g. to index the stack with"""
+        mask = np.ones(len(self), dtype=bool)
+        for name, (lo, hi) in ranges.items():
+            values = getattr(self, name)
+            if lo is not None:
+                mask &= values > lo
+            if hi is not None:
+                mask &= values < hi
+        return mask
+
+    def with_data(self, data):
+        """Args:
+            - data (2D array): e.g. filtered or differentiated spectra, shape (n, len(axis))
+        Returns:
+            - (SpectraStack) with the same axis and metadata (not copied) and data"""
+        data = np.asarray(data)
+        if data.shape != self.data.shape:
+            raise ValueError(f"data has shape {data.shape}, expected {self.data.shape}")
+        return self._rows(data, slice(None))
+
+    def astype(self, dtype):
+        """Returns:
+            - (SpectraStack) with data converted to dtype, e.g. np.float32"""
+        return self.with_data(self.data.astype(dtype))
+
+##### Temperature Segmentation #####
+
+RAMP_LABELS = ('plateau', 'heating', 'cooling') # label codes are indices into this
+SEGMENT_DTYPE = np.dtype([('label', np.int8), ('start', np.int64), ('stop', np.int64),
+                          ('T_start', float), ('T_stop', float), ('T_min', float), ('T_max', float)])
+
+def normalization_ok(norm, max_norm=3., min_norm=-0.1):
+    """Flags poorly normalized spectra, as the checks in plotspec, for a whole stack at once.
+    Args:
+        - norm (2D array): normalized spectra, shape (n, m), e.g. SpectraStack.data
+        - max_norm, min_norm (float): a spectrum exceeding either is poorly normalized
+    Returns:
+        - (1D bool array) shape (n,), False for poorly normalized spectra"""
+    norm = np.atleast_2d(norm)
+    return (np.max(norm, axis=1) <= max_norm) & (np.min(norm, axis=1) >= min_norm)
+
+def ramp_labels(temperature, threshold=6.):
+    """Labels each spectrum as heating, cooling, or plateau from the temperature change since the
+    previous spectrum, as in plotspec: a change of at least threshold is a ramp, anything less a plateau.
+    Args:
+        - temperature (1D array): of consecutive spectra, shape (n,)
+        - threshold (float): deg. C between adjacent spectra to decide whether heating/cooling is occurring
+    Returns:
+        - (1D int8 array) shape (n,), indices into RAMP_LABELS. The first spectrum, which has
+            no previous one, takes the label of the second."""
+    temperature = np.asarray(temperature, dtype=float)
+    change = np.diff(temperature, prepend=temperature[:1])
+    labels = np.zeros(len(temperature), dtype=np.int8)
+    labels[change >= threshold] = RAMP_LABELS.index('heating')
+    labels[change <= -threshold] = RAMP_LABELS.index('cooling')
+    if len(labels) > 1:
+        labels[0] = labels[1]
+    return labels
+
+def ramp_segments(labels, temperature):
+    """Splits a series of labelled spectra into contiguous segments of the same label.
+    Args:
+        - labels (1D int array): as returned by ramp_labels, shape (n,)
+        - temperature (1D array): shape (n,)
+    Returns:
+        - (structured array) one row per segment, with fields 'label', 'start', 'stop' (spectra
+            start:stop), 'T_start', 'T_stop' (first and last temperatures), 'T_min', 'T_max'"""
+    labels, temperature = np.asarray(labels), np.asarray(temperature, dtype=float)
+    if len(labels) == 0:
+        return np.empty(0, dtype=SEGMENT_DTYPE)
+    starts = np.flatnonzero(np.diff(labels, prepend=-1) != 0)
+    stops = np.append(starts[1:], len(labels))
+    ret = np.empty(len(starts), dtype=SEGMENT_DTYPE)
+    ret['label'], ret['start'], ret['stop'] = labels[starts], starts, stops
+    ret['T_start'], ret['T_stop'] = temperature[starts], temperature[stops - 1]
+    ret['T_min'] = np.minimum.reduceat(temperature, starts)
+    ret['T_max'] = np.maximum.reduceat(temperature, starts)
+    return ret
+
+def select_ramp(segments, label, temperature, T_min=None, T_max=None):
+    """Spectra in segments of one kind within a temperature window, e.g. the cooling between 700 and 910 C.
+    Args:
+        - segments (structured array): as returned by ramp_segments
+        - label (str): one of RAMP_LABELS
+        - temperature (1D array): as passed to ramp_segments
+        - T_min, T_max (float): open temperature window; None for no bound
+    Returns:
+        - (1D int array) indices of the spectra, in order"""
+    temperature = np.asarray(temperature, dtype=float)
+    lo = -np.inf if T_min is None else T_min
+    hi = np.inf if T_max is None else T_max
+    found = segments[(segments['label'] == RAMP_LABELS.index(label)) & (segments['T_max'] > lo) & (segments['T_min'] < hi)]
+    if len(found) == 0:
+        return np.zeros(0, dtype=int)
+    # indices start:stop of every segment found, without a Python loop over segments
+    lengths = found['stop'] - found['start']
+    indices = np.arange(lengths.sum()) + np.repeat(found['start'] - np.cumsum(lengths) + lengths, lengths)
+    return indices[(temperature[indices] > lo) & (temperature[indices] < hi)]
+
+##### Denoising #####
+
+# boundary modes of savgol_filter that only depend on spectra near either end of the series, so that
+# blocks with halos give the same result ('wrap' would need the spectra at the other end)
+SAVGOL_MODES = ('interp', 'nearest', 'mirror', 'constant')
+
+def _check_savgol_mode(mode):
+    if mode not in SAVGOL_MODES:
+        raise ValueError(f"mode must be one of {SAVGOL_MODES}, got {mode!r}")
+
+def _savgol_rows(block, window_E, window_t, polyorder, mode, start, stop):
+    """Rows start:stop of noise_reduction of block: Savitzky-Golay along time (axis 0), then energy (axis 1)."""
+    smoothed = savgol_filter(block, window_length=window_t, polyorder=polyorder, axis=0, mode=mode)[start:stop]
+    return savgol_filter(smoothed, window_length=window_E, polyorder=polyorder, axis=1, mode=mode)
+
+def savgol_2d(spectra, window_E=11, window_t=9, *, polyorder, mode='interp', chunk_size=256, out=None):
+    """2D Savitzky-Golay filtering (see fastosh manual 'Two-D filtering') of a (time x energy) matrix,
+    the same as noise_reduction in the xas-time-evolution-* notebooks, done in blocks of chunk_size
+    spectra so that only one block (and window_t // 2 neighbouring spectra either side of it) is
+    in memory at a time. Every spectrum is computed from the same neighbours as when filtering the
+    whole matrix at once, so the result is the same (to rounding with mode 'interp', whose fits at
+    either end of the energy axis are solved for a block of spectra at a time).
+    Args:
+        - spectra (2D array-like): shape (n, m); any object that can be sliced along time, e.g. a
+            memory-mapped array, h5py dataset, or SpectraStack.data
+        - window_E (int): Length of energy (axis 1) window for Savitzky-Golay filter
+        - window_t (int): Length of time (axis 0) window for Savitzky-Golay filter
+        - polyorder (int): of the Savitzky-Golay polynomials; no default, as the notebooks differ
+            (2 with mode 'nearest' in xas-time-evolution-bm23, 3 with mode 'interp' in xas-time-evolution-rock)
+        - mode (str): boundary condition of scipy's savgol_filter, one of SAVGOL_MODES
+        - chunk_size (int): spectra per block
+        - out (2D array, or str): preallocated output of shape (n, m), or a path at which to create a
+            memory-mapped .npy file; if None, a new array
+    Returns:
+        - (2D array) filtered spectra, i.e. out"""
+    _check_savgol_mode(mode)
+    if not hasattr(spectra, 'shape'):
+        spectra = np.asarray(spectra, dtype=float)
+    n, m = spectra.shape
+    if isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=float, shape=(n, m))
+    elif out is None:
+        out = np.empty((n, m))
+    halo = window_t // 2
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        lo, hi = max(0, start - halo), min(n, stop + halo)
+        if mode == 'interp':
+            # spectra within halo of either end are fitted to the first (or last) window_t spectra
+            lo, hi = min(lo, max(0, n - window_t)), max(hi, min(n, window_t))
+        block = np.asarray(spectra[lo:hi], dtype=float)
+        out[start:stop] = _savgol_rows(block, window_E, window_t, polyorder, mode, start - lo, stop - lo)
+    return out
+
+class SavgolStream:
+    """savgol_2d for spectra arriving one at a time, e.g. during a measurement. Each filtered spectrum
+    is emitted as soon as the window_t // 2 spectra after it have arrived (and, with mode 'interp',
+    at least window_t spectra in total), and is the same as when filtering the finished series
+    with savgol_2d."""
+
+    def __init__(self, window_E=11, window_t=9, *, polyorder, mode='interp'):
+        """Args:
+            - window_E, window_t, polyorder, mode: see savgol_2d"""
+        _check_savgol_mode(mode)
+        self.window_E, self.window_t, self.polyorder, self.mode = window_E, window_t, polyorder, mode
+        self.halo = window_t // 2
+        self.received = 0 # spectra pushed so far
+        self.emitted = 0 # filtered spectra returned so far
+        self._buffer = [] # the last spectra, enough to filter those not yet emitted
+        self._first = 0 # index of self._buffer[0] in the series
+
+    def _filter(self, stop):
+        """Filtered spectra self.emitted:stop, from the buffer."""
+        # unless end, the buffer holds halo spectra after stop, so its end is never taken for the series'
+        block = np.array(self._buffer, dtype=float)
+        ret = _savgol_rows(block, self.window_E, self.window_t, self.polyorder, self.mode,
+                           self.emitted - self._first, stop - self._first)
+        self.emitted = stop
+        # keep enough spectra before the next one to emit for its window (and for 'interp' edges at the end)
+        keep = max(self.emitted - self.window_t, 0)
+        del self._buffer[:keep - self._first]
+        self._first = keep
+        return ret
+
+    def push(self, spectrum):
+        """Args:
+            - spectrum (1D array): the next spectrum of the series
+        Returns:
+            - (2D array) filtered spectra that can now be emitted, possibly none, in order"""
+        self._buffer.append(np.asarray(spectrum, dtype=float))
+        self.received += 1
+        if self.mode == 'interp' and self.received < self.window_t:
+            return np.empty((0, len(spectrum)))
+        stop = self.received - self.halo
+        if stop <= self.emitted:
+            return np.empty((0, len(spectrum)))
+        return self._filter(stop)
+
+    def finish(self):
+        """Returns:
+            - (2D array) the remaining filtered spectra, once the last spectrum has been pushed"""
+        if self.emitted >= self.received:
+            return np.empty((0, len(self._buffer[-1]) if self._buffer else 0))
+        return self._filter(self.received)
+
+##### Change Detection #####
+
+def cusum_threshold(arl, drift=0.5):
+    """Threshold of a one-sided CUSUM of standard normal values, such that false alarms come on average
+    once every arl values, by Siegmund's approximation ARL = (exp(2 k b) - 2 k b - 1) / (2 k^2), b = h + 1.166.
+    Args:
+        - arl (float): average number of in-control values between false alarms
+        - drift (float): k, in standard deviations
+    Returns:
+        - (float) h, in standard deviations"""
+    if drift <= 0:
+        raise ValueError("drift must be positive")
+    def siegmund(h):
+        b = 2 * drift * (h + 1.166)
+        return (np.exp(b) - b - 1) / (2 * drift**2)
+    lo, hi = 0., 1.
+    while siegmund(hi) < arl:
+        hi *= 2
+    for _ in range(60): # bisection, the ARL increasing with h
+        mid = 0.5 * (lo + hi)
+        lo, hi = (mid, hi) if siegmund(mid) < arl else (lo, mid)
+    return hi
+
+class ChangeDetector:
+    """Follows a series of spectra one at a time, e.g. during a quick-EXAFS ramp, computing for each
+    new spectrum the total absolute difference to the previous one within each window (as total_abs_diffs
+    in the xas-time-evolution-* notebooks), in O(m) per spectrum. Change points are flagged with a
+    one-sided CUSUM of each window's differences, standardized by a running reference of their usual
+    level: the median and MAD of the last baseline_size differences outside of flagged changes, so
+    that it follows slow drifts (e.g. of the beam) without being pulled up by the changes themselves.
+    The CUSUM accumulates differences larger than usual by more than drift standard deviations, and a
+    change is flagged when it rises above threshold (once, until it is back to zero)."""
+
+    def __init__(self, windows, arl=1e4, drift=0.5, warmup=20, baseline_size=100, threshold=None):
+        """Args:
+            - windows (dict): {name: (axis, (min, max))}, e.g. {'0-3/A': (wavenumbers, kwindow1),
+                '0-70 eV': (energies - edges[elem], Ewindow1)}, the points of the spectra within each
+                open interval being summed over
+            - arl (float): intended average number of spectra between false alarms in each window
+            - drift (float): in standard deviations, differences below usual + drift don't accumulate
+            - warmup (int): number of differences (at least 2) that set each window's usual level before
+                changes are flagged
+            - baseline_size (int): number of recent differences (at least 2) the usual level is taken over
+            - threshold (float): in standard deviations, CUSUM above which a change is flagged;
+                if None, cusum_threshold(arl, drift)"""
+        if warmup < 2 or baseline_size < 2:
+            raise ValueError("warmup and baseline_size must be at least 2, to estimate the spread of the differences")
+        self.names = list(windows)
+        self._indices = [np.flatnonzero((np.asarray(axis) > lo) & (np.asarray(axis) < hi)) for axis, (lo, hi) in windows.values()]
+        empty = [name for name, indices in zip(self.names, self._indices) if len(indices) == 0]
+        if empty:
+            raise ValueError(f"no points of the axis within windows {empty}")
+        self.drift = drift
+        self.threshold = cusum_threshold(arl, drift) if threshold is None else threshold
+        self.warmup = warmup
+        self.count = 0 # spectra pushed so far
+        self.previous = None
+        self.diffs = [] # per spectrum after the first, differences to the previous one in each window
+        self.changes = [] # (index of spectrum, window name) of each change point
+        self.cusum = np.zeros(len(self.names))
+        self._armed = np.ones(len(self.names), dtype=bool) # windows not in a flagged change
+        self._baseline = [deque(maxlen=baseline_size) for _ in self.names] # recent differences outside of changes
+
+    def _window_sums(self, values):
+        return np.array([np.abs(values[indices]).sum() for indices in self._indices])
+
+    def push(self, spectrum):
+        """Args:
+            - spectrum (1D array): the next spectrum, on the same axis as the previous ones
+        Returns:
+            - (list of str) names of the windows in which a change starts at this spectrum"""
+        spectrum = np.array(spectrum, dtype=float)
+        index = self.count
+        self.count += 1
+        if self.previous is None:
+            self.previous = spectrum
+            return []
+        diffs = self._window_sums(spectrum - self.previous)
+        # differences below the rounding error of the spectra themselves are no spread at all
+        resolution = 1e-12 * self._window_sums(spectrum)
+        self.diffs.append(diffs)
+        self.previous = spectrum
+        if len(self.diffs) > self.warmup:
+            baselines = [np.asarray(baseline) for baseline in self._baseline]
+            median = np.array([np.median(baseline) for baseline in baselines])
+            # scaled MAD, the standard deviation for normal differences, floored for flat baselines
+            mad = np.array([np.median(np.abs(baseline - level)) for baseline, level in zip(baselines, median)])
+            std = np.maximum(1.4826 * mad, np.maximum(1e-12 * np.abs(median), resolution))
+            std = np.maximum(std, np.finfo(float).tiny)
+            # consecutive differences share a spectrum, so neighbouring ones are correlated (about 0.22 for
+            # white noise) and their sums vary more than if independent: scale by the long-run standard
+            # deviation of a moving average process, sqrt(1 + 2 rho) with rho the lag-1 autocorrelation
+            cov = np.array([np.mean((baseline[1:] - level) * (baseline[:-1] - level)) for baseline, level in zip(baselines, median)])
+            var = std**2
+            rho = np.clip(np.divide(cov, var, out=np.zeros_like(cov), where=var > 0), 0., 0.5)
+            z = (diffs - median) / (std * np.sqrt(1 + 2 * rho))
+            self.cusum = np.maximum(0., self.cusum + z - self.drift)
+        flagged = self._armed & (self.cusum > self.threshold)
+        self._armed = (self._armed & ~flagged) | (self.cusum == 0.)
+        for baseline, diff, armed in zip(self._baseline, diffs, self._armed):
+            if armed:
+                baseline.append(diff)
+        started = [name for name, flag in zip(self.names, flagged) if flag]
+        self.changes.extend((index, name) for name in started)
+        return started
+
+    def run(self, spectra):
+        """Pushes every spectrum of a finished series, e.g. to compare with what was seen during the measurement.
+        Args:
+            - spectra (2D array): shape (n, m)
+        Returns:
+            - (2D array) differences to the previous spectrum, shape (n - 1, number of windows),
+                i.e. total_abs_diffs of each window as columns"""
+        for spectrum in spectra:
+            self.push(spectrum)
+        return self.history()
+
+    def history(self):
+        """Returns:
+            - (2D array) differences to the previous spectrum so far, shape (count - 1, number of windows)"""
+        return np.array(self.diffs).reshape(-1, len(self.names))
@@ -0,0 +1,276 @@
+"""
+These are functions for finding and reading XAS spectra, as used by xas-time-evolution-rock
+and xas-time-evolution-bm23.
+The ROCK quick-EXAFS data extraction gives a deep directory structure, e.g.
+    <Sample>_Rampe_1/Co_Kedge/Co_<Sample>_Rampe_1_001_av120/normalized/norm_Co_<Sample>_Rampe_1_001_av120_00001.txt
+where each normalized file has a header (with the temperature on its 7th line) and columns of
+shifted energy, normalized signal, reference signal, ref. derivative, and I_0.
+"""
+
+import os
+import re
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import h5py
+
+##### ROCK Quick-EXAFS Catalog #####
+
+CATALOG_FILENAME = 'rock_catalog.sqlite'
+# outside the repository, so that the catalog isn't committed with the results in Output
+CATALOG_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'heo-xas-xrd')
+TEMPERATURE_LINE = 6 # the temperature is on the 7th line of normalized files
+DECIMAL_PATTERN = re.compile(r'\d+.\d+')
+# e.g. norm_Co_WAM39B_Rampe_1_001_av120_00001.txt, or norm_WAM39B_Rampe_1_001_av120_00001.txt
+NORMALIZED_PATTERN = re.compile(r'^norm_(?:(?P<element>[A-Z][a-z]?)_)?(?P<series>.+)_(?P<scan>\d+)_av(?P<av>\d+)_(?P<repeat>\d+)\.txt$')
+EDGE_DIR_PATTERN = re.compile(r'^(?P<element>[A-Z][a-z]?)_Kedge$')
+# e.g. Cu_WAM39B_fin_palier_1_001_av1800, containing the normalized directory
+SCAN_DIR_PATTERN = re.compile(r'^(?P<element>[A-Z][a-z]?)_.+_av\d+$')
+RAMP_PATTERN = re.compile(r'Rampe_(\d+)')
+CATALOG_COLUMNS = ('path', 'element', 'series', 'ramp', 'scan', 'av', 'repeat', 'temperature', 'size', 'mtime_ns')
+
+def read_header_temperature(path):
+    """Args:
+        - path (str): to a ROCK normalized spectrum file
+    Returns:
+        - (float) the temperature in its header, or None if there isn't one"""
+    with open(path, 'r') as f:
+        for i, line in enumerate(f):
+            if i == TEMPERATURE_LINE:
+                match = DECIMAL_PATTERN.search(line)
+                return float(match.group()) if match else None
+    return None
+
+def open_catalog(db_path):
+    """Args:
+        - db_path (str): SQLite file of the catalog, created if it doesn't exist
+    Returns:
+        - (sqlite3.Connection) to the catalog, with rows accessible by column name"""
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    con = sqlite3.connect(db_path)
+    con.row_factory = sqlite3.Row
+    con.execute("""CREATE TABLE IF NOT EXISTS spectra (
+        path TEXT PRIMARY KEY, element TEXT, series TEXT, ramp INTEGER, scan INTEGER, av INTEGER,
+        repeat INTEGER, temperature REAL, size INTEGER, mtime_ns INTEGER)""")
+    con.execute("CREATE INDEX IF NOT EXISTS spectra_selection ON spectra (element, ramp, av)")
+    return con
+
+def _scan_normalized(root):
+    """Yields (path, os.DirEntry, element of the nearest <El>_Kedge directory) for the files of
+    every 'normalized' directory below root, using os.scandir to get the stats with the listing."""
+    stack = [(os.path.abspath(root), None)]
+    while len(stack) > 0:
+        directory, edge_element = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                match = EDGE_DIR_PATTERN.match(entry.name)
+                stack.append((entry.path, match.group('element') if match else edge_element))
+            elif os.path.basename(directory) == 'normalized' and entry.is_file():
+                yield entry.path, entry, edge_element
+
+def catalog_entry(path, stat, edge_element=None):
+    """Args:
+        - path (str): to a normalized spectrum file
+        - stat (os.stat_result): of the file
+        - edge_element (str): element of the <El>_Kedge directory containing it, if any
+    Returns:
+        - (tuple) of the CATALOG_COLUMNS, or None if the file isn't a normalized spectrum (e.g. pivot files)"""
+    match = NORMALIZED_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return None
+    element = match.group('element')
+    if element is None:
+        scan_dir = SCAN_DIR_PATTERN.match(os.path.basename(os.path.dirname(os.path.dirname(path))))
+        element = scan_dir.group('element') if scan_dir else edge_element
+    ramp = RAMP_PATTERN.search(match.group('series'))
+    return (path, element, match.group('series'),
+            int(ramp.group(1)) if ramp else None, int(match.group('scan')), int(match.group('av')),
+            int(match.group('repeat')), read_header_temperature(path), stat.st_size, stat.st_mtime_ns)
+
+def update_catalog(db_path, root, verbose=True):
+    """Scans the normalized files below root, only reading the headers of files that are new or
+    changed (by size or modification time) since the last update, and removing files that no longer exist.
+    Args:
+        - db_path (str): SQLite file of the catalog, see open_catalog
+        - root (str): directory to scan, e.g. of one sample, or of all ROCK XAS data
+        - verbose (bool): print how many files were added, updated, and removed
+    Returns:
+        - (int) number of files added or updated, (int) number of files removed"""
+    prefix = os.path.join(os.path.abspath(root), '')
+    con = open_catalog(db_path)
+    try:
+        known = {row['path']: (row['size'], row['mtime_ns']) for row in
+                 con.execute("SELECT path, size, mtime_ns FROM spectra WHERE substr(path, 1, ?) = ?",
+                             (len(prefix), prefix))}
+        seen = set()
+        changed = []
+        unchanged = 0
+        for path, entry, edge_element in _scan_normalized(root):
+            stat = entry.stat()
+            seen.add(path)
+            if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                unchanged += 1
+                continue
+            row = catalog_entry(path, stat, edge_element)
+            if row is not None:
+                changed.append(row)
+        removed = [(path,) for path in known if path not in seen]
+        with con:
+            con.executemany(f"INSERT OR REPLACE INTO spectra VALUES ({', '.join('?' * len(CATALOG_COLUMNS))})", changed)
+            con.executemany("DELETE FROM spectra WHERE path = ?", removed)
+    finally:
+        con.close()
+    if verbose:
+        print(f"{len(changed)} spectra added or updated, {len(removed)} removed, {unchanged} unchanged")
+    return len(changed), len(removed)
+
+def select_spectra(db_path, element=None, series=None, ramp=None, av=None, root=None):
+    """Selects spectra from the catalog, in order of path (i.e. by directory, then file name).
+    Args:
+        - db_path (str): SQLite file of the catalog, see update_catalog
+        - element (str): e.g. 'Co'
+        - series (str): e.g. 'WAM39B_Rampe_1'; may contain SQL wildcards, e.g. 'WAM39B_%'
+        - ramp (int): ramp number, e.g. 1 for WAM39B_Rampe_1
+        - av (int): number of averaged spectra, e.g. 120
+        - root (str): only spectra below this directory
+        Arguments left as None don't restrict the selection.
+    Returns:
+        - (list of dict) one per spectrum, with the CATALOG_COLUMNS as keys"""
+    conditions, params = [], []
+    for column, value in (('element', element), ('ramp', ramp), ('av', av)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if series is not None:
+        conditions.append("series LIKE ?")
+        params.append(series)
+    if root is not None:
+        prefix = os.path.join(os.path.abspath(root), '')
+        conditions.append("substr(path, 1, ?) = ?")
+        params.extend((len(prefix), prefix))
+    where = f" WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ''
+    con = open_catalog(db_path)
+    try:
+        return [dict(row) for row in con.execute(f"SELECT * FROM spectra{where} ORDER BY path", params)]
+    finally:
+        con.close()
+
+##### ROCK Normalized Spectra #####
+
+ROCK_COLUMNS = ('shifted energy', 'normalized', 'reference', 'reference derivative', 'I0')
+
+def read_rock_normalized(path):
+    """Reads a ROCK normalized spectrum file in one pass: the header (with the temperature) is split
+    off, and the numeric block is parsed at once rather than line by line as np.genfromtxt does.
+    Args:
+        - path (str): to a normalized spectrum file
+    Returns:
+        - (np.ndarray) shape (5, n), rows as in ROCK_COLUMNS: shifted energy, normalized signal,
+            reference signal, ref. deriv., I_0
+        - (dict) 'temperature' (float, or None) from the header, and 'header' (list of str)"""
+    with open(path, 'r') as f:
+        text = f.read()
+    header_lines = []
+    start = 0
+    while text.startswith('#', start):
+        end = text.find('\n', start)
+        end = len(text) if end < 0 else end
+        header_lines.append(text[start:end])
+        start = end + 1
+    # as in read_header_temperature, the temperature line counts from the top of the file
+    top_lines = text.split('\n', TEMPERATURE_LINE + 1)
+    match = DECIMAL_PATTERN.search(top_lines[TEMPERATURE_LINE]) if len(top_lines) > TEMPERATURE_LINE else None
+    temperature = float(match.group()) if match else None
+    block = text[start:]
+    ncols = len(block.lstrip().split('\n', 1)[0].split())
+    values = np.fromstring(block, sep=' ')
+    if ncols == 0 or values.size % ncols != 0:
+        raise ValueError(f"Could not parse the numeric columns of {path}")
+    return values.reshape(-1, ncols).T, {'temperature': temperature, 'header': header_lines}
+
+def load_rock_normalized(paths, workers=8):
+    """Reads many normalized spectrum files on a pool of threads, so that reading is bound by the disk.
+    Args:
+        - paths (iterable of str): e.g. as selected with select_spectra
+        - workers (int): number of processes; 1 to read the files in sequence in this process
+    Returns:
+        - (list of np.ndarray) one (5, n) array per file, in the order of paths; see read_rock_normalized
+        - (np.ndarray) temperatures from the headers (nan where missing)"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(read_rock_normalized, paths))
+    spectra = [columns for columns, _ in results]
+    temperatures = np.array([np.nan if meta['temperature'] is None else meta['temperature'] for _, meta in results])
+    return spectra, temperatures
+
+##### BM23 HDF5 Scans #####
+
+BM23_TEMPERATURE_PATH = 'instrument/EurothermNanodac/measure'
+
+def scan_ids(ranges):
+    """Args:
+        - ranges (iterable of tuple): (start, end, step) as passed to range, e.g. from a BM23 info dictionary
+    Returns:
+        - (list of int) the scan numbers"""
+    return [scanid for start, end, step in ranges for scanid in range(start, end, step)]
+
+def _start_timestamp(scan):
+    """Start time of a Bliss scan group, in seconds since the epoch."""
+    start_time = scan['start_time'][()]
+    if isinstance(start_time, bytes):
+        start_time = start_time.decode()
+    return datetime.fromisoformat(start_time).timestamp()
+
+def read_bm23_scans(path, scans, energy='energy_cenc', signal='mu_fluo'):
+    """Reads scans of a BM23 (Bliss) HDF5 file with h5py, opening it once, as load_from_dictionary
+    does with larch's DataSourceSpecH5 one scan at a time. The first and last points are dropped, as there.
+    Args:
+        - path (str): to the .h5 file
+        - scans (iterable of int): scan numbers, e.g. from scan_ids
+        - energy, signal (str): counters to read from each scan's measurement group
+    Returns:
+        - (dict) 'scan' (n,), 'time' (n,) start time in epoch seconds, 'temperature' (n,) from the
+            Eurotherm (averaged, if it was recorded as an array), 'npts' (n,) points of each scan,
+            and 'energy', 'mu' of shape (n, max(npts)), padded with nan after each scan's points"""
+    scans = list(scans)
+    energies, mus = [], []
+    times, temperatures = np.empty(len(scans)), np.empty(len(scans))
+    with h5py.File(path, 'r') as f:
+        for i, scanid in enumerate(scans):
+            scan = f[f'{scanid}.1']
+            energies.append(scan['measurement'][energy][1:-1])
+            mus.append(scan['measurement'][signal][1:-1])
+            times[i] = _start_timestamp(scan)
+            temperatures[i] = np.mean(scan[BM23_TEMPERATURE_PATH][()])
+    npts = np.array([len(e) for e in energies], dtype=int)
+    shape = (len(scans), npts.max() if len(scans) > 0 else 0)
+    ret = {'scan': np.array(scans, dtype=int), 'time': times, 'temperature': temperatures, 'npts': npts,
+           'energy': np.full(shape, np.nan), 'mu': np.full(shape, np.nan)}
+    for i, (e, mu) in enumerate(zip(energies, mus)):
+        ret['energy'][i, :len(e)] = e
+        ret['mu'][i, :len(mu)] = mu
+    return ret
+
+def load_bm23(info_dict, workers=8, energy='energy_cenc', signal='mu_fluo'):
+    """Reads the scans of several BM23 files, reading different files concurrently on a pool of processes
+    (h5py holds a global lock, so threads would read one file at a time).
+    Args:
+        - info_dict (dict): {sample name: [path to .h5 file, (start, end, step), ...]},
+            as used by load_from_dictionary in xas-time-evolution-bm23
+        - workers (int): number of threads
+        - energy, signal (str): see read_bm23_scans
+    Returns:
+        - (dict) {sample name: dict of arrays, see read_bm23_scans}"""
+    names = list(info_dict)
+    if workers == 1 or len(names) < 2:
+        return {name: read_bm23_scans(info_dict[name][0], scan_ids(info_dict[name][1:]), energy, signal) for name in names}
+    with ProcessPoolExecutor(max_workers=min(workers, len(names))) as executor:
+        futures = [executor.submit(read_bm23_scans, info_dict[name][0], scan_ids(info_dict[name][1:]), energy, signal)
+                   for name in names]
+        return {name: future.result() for name, future in zip(names, futures)}
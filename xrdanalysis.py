@@ -0,0 +1,276 @@
+"""
+These are functions for analyzing azimuthally integrated XRD patterns over time and temperature,
+as used by xrd-time-evolution. The patterns are those written by pyFAI (see xrd-batch-integrate),
+i.e. text files with a '#'-commented header followed by columns of 2-theta and intensity.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+##### Reading Integrated Patterns #####
+
+def parse_pyfai_header(lines):
+    """Args:
+        - lines (list of str): header lines of a pyFAI integrated file, with or without the leading '#'
+    Returns:
+        - (dict) of 'key: value' entries in the header, e.g. 'Wavelength' -> '1.127e-10 m'"""
+    header = dict()
+    for line in lines:
+        line = line.lstrip('#').strip()
+        if ':' in line and not line.startswith('-->'):
+            key, val = line.split(':', 1)
+            header[key.strip()] = val.strip()
+    return header
+
+def read_integrated(path):
+    """Reads a pyFAI integrated pattern in one pass: the '#' header is split off, and the numeric
+    block is parsed at once rather than line by line as np.genfromtxt does.
+    Args:
+        - path (str): to an *_integrated.dat file
+    Returns:
+        - (np.ndarray) 2-theta (or other radial unit), shape (npt,)
+        - (np.ndarray) intensities, shape (frames, npt); frames is 1 except for integrated NeXus stacks
+        - (dict) header entries, see parse_pyfai_header"""
+    with open(path, 'r') as f:
+        text = f.read()
+    header_lines = []
+    start = 0
+    while text.startswith('#', start):
+        end = text.find('\n', start)
+        end = len(text) if end < 0 else end
+        header_lines.append(text[start:end])
+        start = end + 1
+    block = text[start:]
+    first_line = block[:block.find('\n')] if '\n' in block else block
+    ncols = len(first_line.split())
+    values = np.fromstring(block, sep=' ')
+    if ncols == 0 or values.size % ncols != 0:
+        raise ValueError(f"Could not parse the numeric columns of {path}")
+    columns = values.reshape(-1, ncols).T
+    return columns[0], columns[1:], parse_pyfai_header(header_lines)
+
+def load_integrated_dir(in_dir, filenames=None, workers=8, suffix='_integrated.dat'):
+    """Loads a directory of integrated patterns into one contiguous array, parsing files in parallel.
+    Args:
+        - in_dir (str): directory containing integrated patterns
+        - filenames (iterable of str): names within in_dir to read; if None, all files
+            ending in suffix, in sorted order
+        - workers (int): number of threads to parse files with
+        - suffix (str): used to select files when filenames is None
+    Returns:
+        - (np.ndarray) 2-theta grid shared by all files, shape (npt,)
+        - (np.ndarray) intensities, shape (frames, npt), one row per pattern in file order
+        - (dict) per-frame metadata: 'filename' (array of str), 'frame' (index within the file),
+            and 'header' (list of dict, see parse_pyfai_header)"""
+    if filenames is None:
+        filenames = sorted(name for name in os.listdir(in_dir) if name.endswith(suffix))
+    filenames = list(filenames)
+    paths = [os.path.join(in_dir, name) for name in filenames]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(read_integrated, paths))
+    if len(results) == 0:
+        raise ValueError(f"No integrated patterns found in {in_dir}")
+
+    twothetas = results[0][0]
+    for name, (radial, _, _) in zip(filenames, results):
+        if radial.shape != twothetas.shape or not np.allclose(radial, twothetas, rtol=0, atol=1e-9):
+            raise ValueError(f"{name} does not use the same 2-theta grid as {filenames[0]}")
+
+    intensities = np.vstack([intensity for _, intensity, _ in results])
+    meta = {'filename': [], 'frame': [], 'header': []}
+    for name, (_, intensity, header) in zip(filenames, results):
+        for i in range(intensity.shape[0]):
+            meta['filename'].append(name)
+            meta['frame'].append(i)
+            meta['header'].append(header)
+    meta['filename'] = np.array(meta['filename'])
+    meta['frame'] = np.array(meta['frame'])
+    return twothetas, intensities, meta
+
+##### Peak Tracking #####
+
+_LN2 = np.log(2.)
+_GAUSS_NORM = 2. * np.sqrt(_LN2 / np.pi)
+
+def pseudo_voigt(x, area, center, fwhm, eta):
+    """Area-normalized pseudo-Voigt: eta * Lorentzian + (1 - eta) * Gaussian, both with the same FWHM.
+    All arguments broadcast, e.g. x of shape (1, m) with parameters of shape (n, 1)."""
+    u = (x - center) / fwhm
+    lorentz = (2. / (np.pi * fwhm)) / (1. + 4. * u**2)
+    gauss = (_GAUSS_NORM / fwhm) * np.exp(-4. * _LN2 * u**2)
+    return area * (eta * lorentz + (1. - eta) * gauss)
+
+def _peak_model(x, x_mid, params):
+    """Pseudo-Voigt on a linear background, and its Jacobian with respect to params.
+    Args:
+        - x (1D array): shape (m,)
+        - x_mid (float): reference point of the linear background
+        - params (2D array): shape (n, 6), columns area, center, fwhm, eta, offset, slope
+    Returns:
+        - (2D array) model, shape (n, m)
+        - (3D array) Jacobian, shape (n, m, 6)"""
+    area, center, fwhm, eta, offset, slope = (params[:, i:i + 1] for i in range(6))
+    u = (x - center) / fwhm
+    denom = 1. + 4. * u**2
+    lorentz = (2. / (np.pi * fwhm)) / denom
+    gauss = (_GAUSS_NORM / fwhm) * np.exp(-4. * _LN2 * u**2)
+    # derivatives of each profile with respect to center and fwhm
+    dl_dc = lorentz * 8. * u / (denom * fwhm)
+    dl_dw = -lorentz / fwhm + lorentz * 8. * u**2 / (denom * fwhm)
+    dg_dc = gauss * 8. * _LN2 * u / fwhm
+    dg_dw = -gauss / fwhm + gauss * 8. * _LN2 * u**2 / fwhm
+    profile = eta * lorentz + (1. - eta) * gauss
+    model = area * profile + offset + slope * (x - x_mid)
+    jac = np.stack(np.broadcast_arrays(profile,
+                                       area * (eta * dl_dc + (1. - eta) * dg_dc),
+                                       area * (eta * dl_dw + (1. - eta) * dg_dw),
+                                       area * (lorentz - gauss),
+                                       np.ones_like(model),
+                                       x - x_mid + np.zeros_like(model)), axis=-1)
+    return model, jac
+
+def _initial_peak_guess(x, y):
+    """Vectorized starting parameters for each row of y (shape (n, m)) from its edges and maximum."""
+    n, m = y.shape
+    edge = max(1, m // 10)
+    left, right = y[:, :edge].mean(axis=1), y[:, -edge:].mean(axis=1)
+    slope = (right - left) / (x[-edge:].mean() - x[:edge].mean())
+    x_mid = 0.5 * (x[0] + x[-1])
+    background = 0.5 * (left + right)[:, None] + slope[:, None] * (x - x_mid)
+    signal = y - background
+    i_max = np.argmax(signal, axis=1)
+    height = signal[np.arange(n), i_max]
+    # FWHM from the number of points above half maximum
+    step = (x[-1] - x[0]) / (m - 1)
+    fwhm = np.maximum(np.sum(signal > 0.5 * height[:, None], axis=1) * step, 2 * step)
+    eta = np.full(n, 0.5)
+    # area of a pseudo-Voigt of this height and width, for eta = 0.5
+    area = height * fwhm / (0.5 * 2. / np.pi + 0.5 * _GAUSS_NORM)
+    return np.column_stack((area, x[i_max], fwhm, eta, 0.5 * (left + right), slope))
+
+def fit_peaks_batched(x, y, init, max_iter=500, tol=1e-8, xtol=1e-7):
+    """Levenberg-Marquardt fit of a pseudo-Voigt on a linear background, to all rows of y at once.
+    Each row is an independent fit, but every iteration is a handful of array operations over all rows.
+    Args:
+        - x (1D array): shape (m,), the (2-theta) points of the fitting window
+        - y (2D array): shape (n, m), one pattern per row
+        - init (2D array): shape (n, 6), starting area, center, fwhm, eta, offset, slope per row
+        - max_iter (int): maximum number of iterations
+        - tol (float): relative change in the sum of squares below which a row is converged
+        - xtol (float): a row is also converged once a step changes no parameter p by more than
+            xtol * (|p| + xtol)
+    Returns:
+        - (2D array) fitted parameters, shape (n, 6)
+        - (1D array of bool) whether each row converged with a physically sensible result"""
+    x_mid = 0.5 * (x[0] + x[-1])
+    step = (x[-1] - x[0]) / (len(x) - 1)
+    params = np.array(init, dtype=float)
+    model, jac = _peak_model(x, x_mid, params)
+    resid = y - model
+    cost = np.sum(resid**2, axis=1)
+    damping = np.full(len(params), 1e-3)
+    converged = np.zeros(len(params), dtype=bool)
+    for _ in range(max_iter):
+        active = ~converged
+        if not np.any(active):
+            break
+        J, r = jac[active], resid[active]
+        JTJ = np.einsum('nmi,nmj->nij', J, J)
+        JTr = np.einsum('nmi,nm->ni', J, r)
+        # hold eta (and a minimal fwhm) at its bound when the descent direction points outside
+        p = params[active]
+        held = np.zeros_like(JTr, dtype=bool)
+        held[:, 2] = (p[:, 2] <= 0.5 * step) & (JTr[:, 2] < 0)
+        held[:, 3] = ((p[:, 3] >= 1.) & (JTr[:, 3] > 0)) | ((p[:, 3] <= 0.) & (JTr[:, 3] < 0))
+        JTr[held] = 0.
+        JTJ[held[:, :, None] ^ held[:, None, :]] = 0.
+        diag = np.einsum('nii->ni', JTJ)
+        A = JTJ + (damping[active, None] * (diag + 1e-12))[:, :, None] * np.eye(6)
+        try:
+            delta = np.linalg.solve(A, JTr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            delta = np.einsum('nij,nj->ni', np.linalg.pinv(A), JTr)
+        trial = params[active] + delta
+        trial[:, 2] = np.maximum(trial[:, 2], 0.5 * step) # fwhm stays positive
+        trial[:, 3] = np.clip(trial[:, 3], 0., 1.) # eta is a mixing fraction
+        # step actually taken, so that a parameter held at its bound does not prevent convergence
+        small_step = np.all(np.abs(trial - params[active]) < xtol * (np.abs(params[active]) + xtol), axis=1)
+        trial_model, trial_jac = _peak_model(x, x_mid, trial)
+        trial_resid = y[active] - trial_model
+        trial_cost = np.sum(trial_resid**2, axis=1)
+        better = trial_cost <= cost[active]
+        idx = np.flatnonzero(active)
+        accept = idx[better]
+        rel_change = (cost[accept] - trial_cost[better]) / np.maximum(cost[accept], 1e-300)
+        params[accept], model[accept], jac[accept] = trial[better], trial_model[better], trial_jac[better]
+        resid[accept], cost[accept] = trial_resid[better], trial_cost[better]
+        damping[accept] /= 10.
+        damping[idx[~better]] *= 10.
+        converged[accept[(rel_change < tol) | small_step[better]]] = True
+        converged[idx[~better][damping[idx[~better]] > 1e10]] = True # no further progress possible
+    sensible = (params[:, 0] > 0) & (params[:, 1] > x[0]) & (params[:, 1] < x[-1]) & (params[:, 2] < x[-1] - x[0])
+    return params, converged & sensible
+
+def _fit_cost(x, y, params):
+    """Sum of squared residuals of each row of y (shape (n, m)) for the fitted params (shape (n, 6))."""
+    model, _ = _peak_model(x, 0.5 * (x[0] + x[-1]), params)
+    return np.sum((y - model)**2, axis=1)
+
+def track_peaks(twothetas, intensities, windows, max_iter=500):
+    """Fits selected Bragg reflections in every frame of a time series.
+    For each reflection, all frames are fitted at once (see fit_peaks_batched), starting from
+    estimates taken from each frame. All frames after the first are then refitted at once
+    starting from the previous frame's result, keeping whichever fit converged (or else has the
+    lower residual). Frames whose fit still fails are refitted starting from the result of the
+    nearest previous successful frame.
+    Args:
+        - twothetas (1D array): shape (npt,), shared 2-theta grid, e.g. from load_integrated_dir
+        - intensities (2D array): shape (frames, npt)
+        - windows (list of tuple): (2-theta min, 2-theta max) around each reflection to be fitted,
+            containing the peak and some background on either side
+        - max_iter (int): see fit_peaks_batched
+    Returns:
+        - (dict) of arrays of shape (frames, reflections): 'position', 'fwhm', 'intensity'
+            (integrated, background-subtracted), 'eta' (Lorentzian fraction), 'background'
+            (at the peak position), and 'success' (bool)"""
+    n = intensities.shape[0]
+    keys = ('position', 'fwhm', 'intensity', 'eta', 'background', 'success')
+    ret = {key: np.zeros((n, len(windows)), dtype=bool if key == 'success' else float) for key in keys}
+    for j, (lo, hi) in enumerate(windows):
+        sel = (twothetas >= lo) & (twothetas <= hi)
+        x, y = twothetas[sel], intensities[:, sel]
+        params, ok = fit_peaks_batched(x, y, _initial_peak_guess(x, y), max_iter)
+        if n > 1:
+            # seed every frame from the previous one: neighbouring frames differ little
+            chained, chained_ok = fit_peaks_batched(x, y[1:], params[:-1], max_iter)
+            own_ok, own_cost = ok[1:], _fit_cost(x, y[1:], params[1:])
+            take = (chained_ok & ~own_ok) | ((chained_ok == own_ok) & (_fit_cost(x, y[1:], chained) < own_cost))
+            params[1:][take], ok[1:][take] = chained[take], chained_ok[take]
+        if np.any(ok) and not np.all(ok):
+            # seed each failed frame from the closest previous (or else the first) successful frame
+            good = np.flatnonzero(ok)
+            bad = np.flatnonzero(~ok)
+            seed = good[np.maximum(np.searchsorted(good, bad) - 1, 0)]
+            refit, refit_ok = fit_peaks_batched(x, y[bad], params[seed], max_iter)
+            params[bad[refit_ok]] = refit[refit_ok]
+            ok[bad[refit_ok]] = True
+        x_mid = 0.5 * (x[0] + x[-1])
+        ret['position'][:, j] = params[:, 1]
+        ret['fwhm'][:, j] = params[:, 2]
+        ret['intensity'][:, j] = params[:, 0]
+        ret['eta'][:, j] = params[:, 3]
+        ret['background'][:, j] = params[:, 4] + params[:, 5] * (params[:, 1] - x_mid)
+        ret['success'][:, j] = ok
+    return ret
+
+def cubic_lattice_parameter(twotheta, hkl, wavelength):
+    """Args:
+        - twotheta (array-like): peak positions (degrees)
+        - hkl (tuple of int): Miller indices of the reflection
+        - wavelength (float): X-ray wavelength, in the units wanted for the lattice parameter
+    Returns:
+        - (array-like) cubic lattice parameter from Bragg's law, a = d * sqrt(h^2 + k^2 + l^2)"""
+    d = wavelength / (2. * np.sin(np.radians(np.asarray(twotheta)) / 2.))
+    return d * np.sqrt(np.sum(np.square(hkl)))
@@ -0,0 +1,673 @@
+"""
+These are functions for azimuthal integration of XRD area detector images with pyFAI,
+as used by xrd-batch-integrate. Images are read, integrated, and written one at a time
+so that memory use does not grow with the number of files in the input directory.
+"""
+
+import os
+import json
+import hashlib
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+import fabio
+import h5py
+import pyFAI
+import pyFAI.io
+import pyFAI.units
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.nxs', '.edf')
+NXS_CHUNK = 16 # frames of a NeXus stack read at once
+MANIFEST_FILENAME = 'integration_manifest.json'
+ENGINE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'heo-xas-xrd', 'pyfai-engines')
+
+# one azimuthal integrator per worker thread/process, see _worker_integrator
+_worker_state = threading.local()
+# pyFAI's engine setup (first integrate1d call) is not thread-safe, so it is serialized
+_engine_setup_lock = threading.Lock()
+
+##### Reading Detector Images #####
+
+# EDF DataType keywords and the corresponding numpy types (EDF "Long" is 32 bits)
+EDF_DTYPES = {'UnsignedByte': 'u1', 'SignedByte': 'i1', 'UnsignedShort': 'u2', 'SignedShort': 'i2',
+              'UnsignedInteger': 'u4', 'SignedInteger': 'i4', 'UnsignedLong': 'u4', 'SignedLong': 'i4',
+              'Unsigned64': 'u8', 'Signed64': 'i8', 'FloatValue': 'f4', 'Float': 'f4', 
+              'DoubleValue': 'f8', 'Double': 'f8'}
+
+def _match_size(arr, imsize):
+    """Returns arr unchanged if it is already of shape imsize (numpy order, as detector.MAX_SHAPE),
+    otherwise resamples it to that shape with PIL (note PIL takes sizes as (width, height))."""
+    if tuple(arr.shape) == tuple(imsize):
+        return arr
+    if arr.ndim != 2:
+        raise ValueError(f"Expected a 2D image to resample to {tuple(imsize)}, got shape {arr.shape}")
+    im = Image.fromarray(np.ascontiguousarray(arr)).resize((imsize[1], imsize[0]))
+    ret = np.array(im)
+    if ret.shape != tuple(imsize):
+        raise ValueError(f"Resampled image has shape {ret.shape}, expected {tuple(imsize)}")
+    return ret
+
+def _mmap_dataset(dset):
+    """Memory-maps an h5py dataset if it is stored contiguously and uncompressed, otherwise None."""
+    if dset.chunks is not None or dset.compression is not None or dset.dtype.kind not in 'iuf':
+        return None
+    offset = dset.id.get_offset()
+    if offset is None: # storage not yet allocated
+        return None
+    return np.memmap(dset.file.filename, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+
+def nxs_signal_dataset(f, entry='entry', group='scan_data'):
+    """Args:
+        - f (h5py.File): an open NeXus file
+        - entry, group (str): names of the NXentry and the NXdata group holding the detector images
+    Returns:
+        - (h5py.Dataset) the NeXus signal dataset of the group, i.e. what nexusformat calls nxsignal"""
+    data = f[entry][group]
+    signal = data.attrs.get('signal')
+    if signal is not None:
+        signal = signal.decode() if isinstance(signal, bytes) else str(signal)
+        return data[signal]
+    for dset in data.values(): # older convention: signal=1 attribute on the dataset itself
+        flag = dset.attrs.get('signal')
+        if isinstance(flag, bytes):
+            flag = flag.decode()
+        if flag is not None and str(flag).strip() == '1':
+            return dset
+    raise KeyError(f"No NeXus signal found in {f.filename}:/{entry}/{group}")
+
+def read_nxs_image(path, imsize):
+    """Reads the image directly from the HDF5 dataset, memory-mapping it when the
+    dataset is stored contiguously. No resampling is done if the shape already matches.
+    Args:
+        - path (str): to an *.nxs file with image
+        - imsize (tuple): (size_x, size_y)
+    Returns:
+        - (np.ndarray) image of shape (size_x, size_y)"""
+    with h5py.File(path, 'r') as f:
+        dset = nxs_signal_dataset(f)
+        arr = _mmap_dataset(dset)
+        if arr is None:
+            arr = dset[0] if dset.ndim == 3 else dset[()]
+        elif arr.ndim == 3:
+            arr = arr[0]
+    return _match_size(arr, imsize)
+
+def edf_header(path):
+    """Args:
+        - path (str): to an *.edf file
+    Returns:
+        - (dict) keys and values of the first header block
+        - (int) size of the header in bytes, i.e. offset of the first frame's data"""
+    header = dict()
+    with open(path, 'rb') as f:
+        raw = f.read(512)
+        while b'}' not in raw:
+            block = f.read(512)
+            if not block:
+                raise ValueError(f"Unterminated EDF header in {path}")
+            raw += block
+    end = raw.index(b'}') + 1
+    size = end + 1 if raw[end:end + 1] == b'\n' else end
+    for line in raw[raw.index(b'{') + 1:end - 1].decode('ascii', errors='replace').split(';'):
+        if '=' in line:
+            key, val = line.split('=', 1)
+            header[key.strip()] = val.strip()
+    return header, size
+
+def _mmap_edf(path):
+    """Memory-maps the first frame of an uncompressed EDF file, otherwise None."""
+    header, offset = edf_header(path)
+    dtype = EDF_DTYPES.get(header.get('DataType'))
+    if dtype is None or header.get('Compression', 'None').lower() not in ('none', 'no'):
+        return None
+    order = '>' if header.get('ByteOrder') == 'HighByteFirst' else '<'
+    shape = (int(header['Dim_2']), int(header['Dim_1'])) if 'Dim_2' in header else (int(header['Dim_1']),)
+    dtype = np.dtype(order + dtype)
+    if int(header.get('Size', dtype.itemsize * np.prod(shape))) != dtype.itemsize * np.prod(shape):
+        return None
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+def read_edf_image(path, imsize):
+    """See read_nxs_image. Uncompressed files are memory-mapped, others are read with fabio."""
+    arr = _mmap_edf(path)
+    if arr is None:
+        arr = fabio.open(path).data
+    return _match_size(arr.squeeze(), imsize)
+
+def read_image(path, imsize):
+    """Reads a NeXus (*.nxs) or European Data Format (*.edf) image, chosen by extension.
+    Args:
+        - path (str): to the image file
+        - imsize (tuple): (size_x, size_y)
+    Returns:
+        - (np.ndarray) image, or None if the extension is not recognized"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.nxs':
+        return read_nxs_image(path, imsize)
+    elif ext == '.edf':
+        return read_edf_image(path, imsize)
+    return None
+
+def nxs_frame_count(path):
+    """Returns the number of frames (length of the first axis) in a NeXus image stack."""
+    with h5py.File(path, 'r') as f:
+        dset = nxs_signal_dataset(f)
+        return dset.shape[0] if dset.ndim == 3 else 1
+
+def iter_nxs_frames(path, imsize, chunk=NXS_CHUNK):
+    """Reads a multi-frame NeXus stack a few frames at a time along its first axis.
+    Args:
+        - path (str): to an *.nxs file with a (frames, size_x, size_y) image stack
+        - imsize (tuple): (size_x, size_y)
+        - chunk (int): number of frames read at once
+    Yields:
+        - (int, np.ndarray) index of the first frame in the chunk, and the chunk of
+            shape (<= chunk, size_x, size_y)"""
+    with h5py.File(path, 'r') as f:
+        dset = nxs_signal_dataset(f)
+        mapped = _mmap_dataset(dset)
+        source = dset if mapped is None else mapped
+        for start in range(0, dset.shape[0], chunk):
+            frames = source[start:start + chunk]
+            if tuple(frames.shape[1:]) != tuple(imsize):
+                frames = np.array([_match_size(frame, imsize) for frame in frames])
+            yield start, frames
+
+##### Streaming Integration #####
+
+def integrated_filename(in_filename):
+    """Name of the file an integrated pattern is written to, e.g. abc.nxs -> abc_integrated.dat"""
+    return os.path.splitext(in_filename)[0] + '_integrated.dat'
+
+def list_images(in_dir):
+    """Args:
+        - in_dir (str): directory containing detector images
+    Returns:
+        - (list of str) sorted names of the files in in_dir with a recognized image extension"""
+    names = []
+    for item in sorted(os.listdir(in_dir)):
+        if item.lower().endswith(IMAGE_EXTENSIONS):
+            names.append(item)
+        else:
+            print("Unrecognized extension:", item)
+    return names
+
+def iter_images(in_dir, imsize, filenames=None):
+    """Lazily reads images, so that only one is held in memory at a time.
+    Args:
+        - in_dir (str): directory containing detector images
+        - imsize (tuple): (size_x, size_y), e.g. azimuthal integrator's detector.MAX_SHAPE
+        - filenames (iterable of str): names within in_dir to read; if None, uses list_images(in_dir)
+    Yields:
+        - (str, np.ndarray) file name and image"""
+    if filenames is None:
+        filenames = list_images(in_dir)
+    for in_filename in filenames:
+        yield in_filename, read_image(os.path.join(in_dir, in_filename), imsize)
+
+def integrate_nxs_stack(azim_int, path, npt=1000, unit="2th_deg", chunk=NXS_CHUNK):
+    """Integrates every frame of a multi-frame NeXus file with the same integrator.
+    Args:
+        - azim_int (pyFAI AzimuthalIntegrator)
+        - path (str): to an *.nxs file with a (frames, size_x, size_y) image stack
+        - npt (int): number of points in the integrated patterns
+        - unit (str): pyFAI radial unit
+        - chunk (int): number of frames read at once
+    Returns:
+        - (np.ndarray) radial axis, shape (npt,)
+        - (np.ndarray) intensities, shape (frames, npt)"""
+    radial = None
+    intensities = np.empty((nxs_frame_count(path), npt))
+    for start, frames in iter_nxs_frames(path, azim_int.detector.MAX_SHAPE, chunk):
+        for i, frame in enumerate(frames):
+            result = azim_int.integrate1d(frame, npt, unit=unit)
+            intensities[start + i] = result.intensity
+            radial = result.radial
+    return radial, intensities
+
+def integrate_frames(azim_int, in_path, npt=1000, unit="2th_deg", chunk=NXS_CHUNK):
+    """Integrates every frame of one image file without writing anything.
+    Returns:
+        - (np.ndarray) radial axis, shape (npt,)
+        - (np.ndarray) intensities, shape (frames, npt); frames is 1 except for NeXus stacks"""
+    if in_path.lower().endswith('.nxs') and nxs_frame_count(in_path) > 1:
+        return integrate_nxs_stack(azim_int, in_path, npt, unit, chunk)
+    result = azim_int.integrate1d(read_image(in_path, azim_int.detector.MAX_SHAPE), npt, unit=unit)
+    return result.radial, result.intensity[np.newaxis]
+
+def write_integrated_stack(out_filepath, radial, intensities, unit="2th_deg", source=None):
+    """Writes a (frames x npt) integrated stack as text columns: the radial axis, then
+    one intensity column per frame. Readable with np.genfromtxt(out_filepath).transpose()."""
+    header = f"Integrated stack of {intensities.shape[0]} frames"
+    if source is not None:
+        header += f" from {source}"
+    header += "\n" + " ".join([unit] + [f"I_{i}" for i in range(intensities.shape[0])])
+    np.savetxt(out_filepath, np.column_stack((radial, intensities.T)), header=header, fmt='%.6e')
+
+def integrate_file(azim_int, in_path, out_filepath, npt=1000, unit="2th_deg", chunk=NXS_CHUNK):
+    """Integrates one image file, writing the pattern to out_filepath. Multi-frame NeXus
+    files are integrated frame by frame and written as one (frames x npt) stack.
+    Returns:
+        - (int) number of frames integrated"""
+    if in_path.lower().endswith('.nxs') and nxs_frame_count(in_path) > 1:
+        radial, intensities = integrate_nxs_stack(azim_int, in_path, npt, unit, chunk)
+        write_integrated_stack(out_filepath, radial, intensities, unit, source=in_path)
+        return intensities.shape[0]
+    image = read_image(in_path, azim_int.detector.MAX_SHAPE)
+    azim_int.integrate1d(image, npt, unit=unit, filename=out_filepath)
+    return 1
+
+def integrate_stream(azim_int, in_dir, out_dir, npt=1000, unit="2th_deg", filenames=None, verbose=True, store=None):
+    """Reads, integrates, and writes each image in turn. Peak memory is a few frames
+    regardless of how many files are in in_dir.
+    Args:
+        - azim_int (pyFAI AzimuthalIntegrator): e.g. from pyFAI.load(poni_file)
+        - in_dir (str): directory containing *.nxs or *.edf images
+        - out_dir (str): directory to write *_integrated.dat files to
+        - npt (int): number of points in the integrated pattern
+        - unit (str): pyFAI radial unit
+        - filenames (iterable of str): names within in_dir to integrate; if None, all images in in_dir
+        - verbose (bool): print each file as it is processed
+        - store (IntegratedStore): if given, patterns are appended to it instead of
+            being written to out_dir as text files
+    Yields:
+        - (str, str) input file name and the path written to, after each integration"""
+    if filenames is None:
+        filenames = list_images(in_dir)
+    for in_filename in filenames:
+        in_path = os.path.join(in_dir, in_filename)
+        out_filepath = os.path.join(out_dir, integrated_filename(in_filename)) if store is None else store.path
+        if verbose:
+            print("Using image from:", in_filename)
+            print("Writing to:", out_filepath)
+        if store is None:
+            integrate_file(azim_int, in_path, out_filepath, npt, unit)
+        else:
+            store.append(*integrate_frames(azim_int, in_path, npt, unit), source=in_filename)
+        yield in_filename, out_filepath
+
+##### Binary Store #####
+
+class IntegratedStore:
+    """A single HDF5 file holding all integrated patterns of e.g. one ramp, as an alternative to
+    one text file per frame. Layout:
+        - radial (npt,): the radial (2-theta) axis, stored once, with the unit as attribute
+        - intensity (frames, npt): chunked, and extended as patterns are appended
+        - source (frames,): name of the image file each pattern came from
+        - frame (frames,): index of the pattern within its image file (0 except for NeXus stacks)
+    The pyFAI header (geometry, wavelength, ...) is the same for all frames integrated with
+    one PONI file, so it is stored once as the 'header' attribute. Use as a context manager,
+    or call close() when done. See load_store for reading."""
+
+    def __init__(self, path, header=None, unit="2th_deg", mode='w', chunk_frames=64):
+        """Args:
+            - path (str): to the *.h5 file
+            - header (list of str or str): pyFAI header, e.g. azim_int.make_headers()
+            - unit (str): radial unit of the patterns
+            - mode (str): 'w' to start a new store, 'a' to append to an existing one
+            - chunk_frames (int): number of patterns per HDF5 chunk"""
+        self.path = path
+        self.unit = unit
+        self.chunk_frames = chunk_frames
+        self._file = h5py.File(path, mode)
+        if header is not None:
+            self._file.attrs['header'] = header if isinstance(header, str) else '\n'.join(header)
+
+    def append(self, radial, intensities, source, frames=None):
+        """Args:
+            - radial (1D array): radial axis; must match the one already stored, if any
+            - intensities (1D or 2D array): one pattern, or (frames, npt) patterns
+            - source (str): name of the image file the patterns came from
+            - frames (1D array of int): index of each pattern in its file; defaults to 0, 1, ..."""
+        intensities = np.atleast_2d(intensities)
+        n, npt = intensities.shape
+        if frames is None:
+            frames = np.arange(n)
+        if 'radial' not in self._file:
+            self._file.create_dataset('radial', data=radial).attrs['unit'] = self.unit
+            self._file.create_dataset('intensity', shape=(0, npt), maxshape=(None, npt), dtype='f4',
+                                      chunks=(self.chunk_frames, npt))
+            self._file.create_dataset('source', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                                      chunks=(self.chunk_frames,))
+            self._file.create_dataset('frame', shape=(0,), maxshape=(None,), dtype='i4',
+                                      chunks=(self.chunk_frames,))
+        elif not np.allclose(self._file['radial'][()], radial):
+            raise ValueError(f"Radial axis of {source} does not match the one in {self.path}")
+        start = self._file['intensity'].shape[0]
+        for name, values in (('intensity', intensities), ('source', [source] * n), ('frame', frames)):
+            dset = self._file[name]
+            dset.resize(start + n, axis=0)
+            dset[start:] = values
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_store(path, lazy=True):
+    """Args:
+        - path (str): to a store written by IntegratedStore
+        - lazy (bool): if True, intensities are left on disk and read slice by slice on access,
+            so stores larger than memory can be used; otherwise read in a single binary read
+    Returns:
+        - (np.ndarray) radial axis, shape (npt,)
+        - (h5py.Dataset or np.ndarray) intensities, shape (frames, npt). The lazy dataset keeps
+            the file open: slice it (e.g. intensities[::10], intensities[()] for everything), and
+            call intensities.file.close() when done
+        - (dict) per-frame metadata arrays 'source' and 'frame', plus 'unit' and 'header'"""
+    f = h5py.File(path, 'r')
+    try:
+        radial = f['radial'][()]
+        meta = {'source': f['source'].asstr()[()], 'frame': f['frame'][()],
+                'unit': f['radial'].attrs.get('unit'), 'header': f.attrs.get('header')}
+        if lazy:
+            return radial, f['intensity'], meta
+        intensities = f['intensity'][()]
+    except BaseException:
+        f.close()
+        raise
+    f.close()
+    return radial, intensities, meta
+
+##### Integration Engine Cache #####
+
+Integrated1D = namedtuple('Integrated1D', ('radial', 'intensity'))
+
+class CachedIntegrator:
+    """Drop-in replacement for the integrator returned by pyFAI.load(poni_file), for 1D integration.
+    The first integrate1d call for a given image shape, npt, and unit normally spends seconds
+    building pyFAI's sparse (CSR) integration matrix. Here, that matrix and the solid angle
+    normalization are saved to cache_dir, keyed by the PONI file contents, image shape, npt, unit,
+    and detector mask, so that later sessions (and every worker of integrate_parallel) load
+    it instead. Integration is then a single sparse matrix-vector product, equivalent to
+    azim_int.integrate1d with its default bbox pixel splitting and solid angle correction.
+    Everything other than integrate1d is delegated to the underlying pyFAI integrator."""
+
+    def __init__(self, poni_file, cache_dir=ENGINE_CACHE_DIR):
+        """Args:
+            - poni_file (str): path to the PONI geometry file
+            - cache_dir (str): directory in which integration matrices are saved"""
+        self.poni_file = poni_file
+        self.cache_dir = cache_dir
+        self.azim_int = pyFAI.load(poni_file)
+        with open(poni_file, 'rb') as f:
+            self._poni_bytes = f.read()
+        self._engines = dict()
+
+    def __getattr__(self, name):
+        if name == 'azim_int': # not yet initialized
+            raise AttributeError(name)
+        return getattr(self.azim_int, name)
+
+    def __str__(self):
+        return str(self.azim_int)
+
+    def engine_key(self, shape, npt, unit):
+        """Returns the hex digest identifying the integration matrix for these settings."""
+        sha = hashlib.sha256(self._poni_bytes)
+        sha.update(repr((tuple(shape), int(npt), str(unit))).encode())
+        mask = self.azim_int.detector.mask
+        if mask is not None:
+            sha.update(np.ascontiguousarray(mask, dtype=np.int8).tobytes())
+        return sha.hexdigest()
+
+    def prepare(self, shape, npt, unit="2th_deg"):
+        """Loads the integration matrix from the cache, or builds and saves it if absent.
+        Returns:
+            - (tuple) CSR matrix of shape (npt, pixels), normalization per bin, radial axis"""
+        key = self.engine_key(shape, npt, unit)
+        if key in self._engines:
+            return self._engines[key]
+        path = os.path.join(self.cache_dir, key)
+        names = ('data', 'indices', 'indptr', 'normalization', 'radial')
+        if not all(os.path.isfile(os.path.join(path, name + '.npy')) for name in names):
+            self._build_engine(path, shape, npt, unit)
+        data, indices, indptr, normalization, radial = (np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                                                         for name in names)
+        matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=(npt, int(np.prod(shape))), copy=False)
+        self._engines[key] = (matrix, np.asarray(normalization), np.asarray(radial))
+        return self._engines[key]
+
+    def _build_engine(self, path, shape, npt, unit):
+        """Computes the integration matrix with pyFAI and writes it to path."""
+        engine = self.azim_int.setup_sparse_integrator(shape, npt, mask=self.azim_int.detector.mask,
+                                                       unit=unit, split="bbox", algo="CSR", scale=False)
+        data, indices, indptr = engine.lut
+        matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=(npt, int(np.prod(shape))))
+        solid_angle = self.azim_int.solidAngleArray(shape, absolute=False)
+        arrays = {'data': data, 'indices': indices, 'indptr': indptr,
+                  'normalization': matrix @ solid_angle.ravel().astype(np.float64),
+                  'radial': np.asarray(engine.bin_centers) * pyFAI.units.to_unit(unit).scale}
+        # write to a temporary directory first, so that concurrent builds never leave partial files
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), arr)
+        try:
+            os.replace(tmp_path, path)
+        except OSError: # another worker finished first
+            for name in arrays:
+                os.remove(os.path.join(tmp_path, name + '.npy'))
+            os.rmdir(tmp_path)
+
+    def integrate1d(self, data, npt, unit="2th_deg", filename=None, **kwargs):
+        """Same as pyFAI's integrate1d with default options, using the cached matrix.
+        Any other keyword arguments (e.g. method, polarization_factor) fall back to pyFAI."""
+        if kwargs:
+            return self.azim_int.integrate1d(data, npt, unit=unit, filename=filename, **kwargs)
+        matrix, normalization, radial = self.prepare(data.shape, npt, unit)
+        signal = matrix @ np.ravel(data).astype(np.float64)
+        intensity = np.divide(signal, normalization, out=np.zeros_like(signal), where=normalization != 0)
+        if filename is not None:
+            writer = pyFAI.io.DefaultAiWriter(filename, self.azim_int)
+            writer.save1D(filename, radial, intensity, None, unit,
+                          has_mask=self.azim_int.detector.mask is not None, normalization_factor=1.0)
+        return Integrated1D(radial, intensity)
+
+##### Parallel Integration #####
+
+def _worker_integrator(poni_file, cache_dir=None):
+    """Returns this worker's azimuthal integrator, loading it from the PONI file
+    only the first time it is needed by the current thread (or process)."""
+    if getattr(_worker_state, 'settings', None) != (poni_file, cache_dir):
+        if cache_dir is None:
+            _worker_state.azim_int = pyFAI.load(poni_file)
+        else:
+            _worker_state.azim_int = CachedIntegrator(poni_file, cache_dir)
+        _worker_state.settings = (poni_file, cache_dir)
+        _worker_state.engine_key = None
+    return _worker_state.azim_int
+
+def _integrate_file(job):
+    """Worker task: reads and integrates a single image file. The result is written to
+    file, or returned as (radial, intensities) arrays if out_dir is None.
+    Returns:
+        - (tuple) input file name, path written to (or the arrays), and number of frames integrated"""
+    poni_file, cache_dir, in_dir, out_dir, in_filename, npt, unit = job
+    azim_int = _worker_integrator(poni_file, cache_dir)
+    in_path = os.path.join(in_dir, in_filename)
+    if out_dir is None:
+        task, args = integrate_frames, (azim_int, in_path, npt, unit)
+    else:
+        out_filepath = os.path.join(out_dir, integrated_filename(in_filename))
+        task, args = integrate_file, (azim_int, in_path, out_filepath, npt, unit)
+    if getattr(_worker_state, 'engine_key', None) != (npt, unit):
+        with _engine_setup_lock:
+            result = task(*args)
+        _worker_state.engine_key = (npt, unit)
+    else:
+        result = task(*args)
+    if out_dir is None:
+        return in_filename, result, result[1].shape[0]
+    return in_filename, out_filepath, result
+
+def iter_integrate_parallel(poni_file, in_dir, out_dir, npt=1000, unit="2th_deg", filenames=None,
+                       workers=None, threads=False, verbose=True, store=None, cache_dir=None):
+    """Integrates the images in in_dir over a pool of workers, yielding each result as soon as it
+    and those before it are done, so that callers can record progress that survives an interruption
+    or a failing file. Each worker builds the azimuthal integrator from poni_file once and reuses
+    it for all of its images.
+    Args:
+        - poni_file (str): path to the PONI geometry file
+        - in_dir (str): directory containing *.nxs or *.edf images
+        - out_dir (str): directory to write *_integrated.dat files to
+        - npt (int): number of points in the integrated pattern
+        - unit (str): pyFAI radial unit
+        - filenames (iterable of str): names within in_dir to integrate; if None, all images in in_dir
+        - workers (int): number of workers; if None, one per CPU
+        - threads (bool): use a thread pool instead of a process pool. Only worthwhile
+            if the pyFAI integration method releases the GIL (e.g. OpenCL or Cython engines)
+        - verbose (bool): print progress and throughput
+        - store (IntegratedStore): if given, workers send their patterns back to be appended
+            to it (in the order of filenames) instead of writing text files to out_dir
+        - cache_dir (str): if given, workers use a CachedIntegrator with this cache directory,
+            so the integration matrix is computed at most once rather than once per worker
+    Yields:
+        - (tuple) (input file name, path written to) in the same order as filenames"""
+    if filenames is None:
+        filenames = list_images(in_dir)
+    job_out_dir = out_dir if store is None else None
+    jobs = [(poni_file, cache_dir, in_dir, job_out_dir, in_filename, npt, unit) for in_filename in filenames]
+    if cache_dir is not None and len(jobs) > 0:
+        # build the cached matrix once here, before the workers all look for it
+        warm = CachedIntegrator(poni_file, cache_dir)
+        warm.prepare(warm.detector.MAX_SHAPE, npt, unit)
+    if workers is None:
+        workers = os.cpu_count()
+    if threads:
+        executor, chunksize = ThreadPoolExecutor(max_workers=workers), 1
+    else:
+        # batch the jobs sent to each process to limit inter-process overhead
+        executor, chunksize = ProcessPoolExecutor(max_workers=workers), max(1, len(jobs) // (4 * workers))
+
+    done = 0
+    frames = 0 # a NeXus file may hold many frames
+    start = time.perf_counter()
+    with executor:
+        for in_filename, result, n_frames in executor.map(_integrate_file, jobs, chunksize=chunksize):
+            if store is not None:
+                store.append(*result, source=in_filename)
+                result = store.path
+            done += 1
+            frames += n_frames
+            yield in_filename, result
+            if verbose and done % 100 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{done}/{len(jobs)} files, {frames / elapsed:.1f} frames/s ({done / elapsed:.1f} files/s)")
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print(f"Integrated {frames} frames from {done} files in {elapsed:.1f} s "
+              f"({frames / max(elapsed, 1e-9):.1f} frames/s, {done / max(elapsed, 1e-9):.1f} files/s) on {workers} workers")
+
+def integrate_parallel(poni_file, in_dir, out_dir, npt=1000, unit="2th_deg", filenames=None,
+                       workers=None, threads=False, verbose=True, store=None, cache_dir=None):
+    """iter_integrate_parallel, returning all results once every image is integrated.
+    Returns:
+        - (list of tuple) (input file name, path written to) in the same order as filenames"""
+    return list(iter_integrate_parallel(poni_file, in_dir, out_dir, npt, unit, filenames, workers,
+                                        threads, verbose, store, cache_dir))
+
+##### Incremental Integration #####
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file's contents, e.g. for a PONI file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_manifest(path):
+    """Args:
+        - path (str): to a manifest as written by save_manifest
+    Returns:
+        - (dict) {input file name: entry dict}, empty if the manifest does not exist yet"""
+    if not os.path.isfile(path):
+        return dict()
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, path):
+    """Writes the manifest to a temporary file first, so an interrupted run never
+    leaves a truncated manifest behind."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def manifest_entry(in_path, poni_hash, npt, unit):
+    """Args:
+        - in_path (str): path to the input image
+        - poni_hash (str): as returned by file_hash on the PONI file
+        - npt (int), unit (str): integration parameters
+    Returns:
+        - (dict) what determines the integrated output of in_path"""
+    stat = os.stat(in_path)
+    return {'path': os.path.abspath(in_path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'poni_hash': poni_hash, 'npt': npt, 'unit': unit}
+
+def select_changed(in_dir, out_dir, filenames, manifest, poni_hash, npt, unit):
+    """Args:
+        - in_dir, out_dir (str): input image and output directories
+        - filenames (iterable of str): candidate names within in_dir
+        - manifest (dict): as returned by load_manifest
+        - poni_hash (str), npt (int), unit (str): current integration settings
+    Returns:
+        - (list of str) names whose manifest entry is missing or out of date,
+            or whose integrated file no longer exists
+        - (dict) {name: up-to-date manifest entry} for all of filenames"""
+    changed = []
+    entries = dict()
+    for in_filename in filenames:
+        entry = manifest_entry(os.path.join(in_dir, in_filename), poni_hash, npt, unit)
+        entries[in_filename] = entry
+        out_filepath = os.path.join(out_dir, integrated_filename(in_filename))
+        if manifest.get(in_filename) != entry or not os.path.isfile(out_filepath):
+            changed.append(in_filename)
+    return changed, entries
+
+def integrate_incremental(poni_file, in_dir, out_dir, npt=1000, unit="2th_deg", filenames=None,
+                          workers=1, threads=False, verbose=True, cache_dir=None):
+    """Integrates only the images that are new or changed since the last run, according to
+    a manifest kept in out_dir. An image is re-integrated if its size or modification time,
+    the PONI file contents, npt, or unit differ from those recorded in the manifest.
+    Args:
+        - see integrate_parallel; workers=1 integrates in the calling process with integrate_stream
+    Returns:
+        - (list of tuple) (input file name, path written to) for the images that were integrated"""
+    if filenames is None:
+        filenames = list_images(in_dir)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path)
+    poni_hash = file_hash(poni_file)
+    changed, entries = select_changed(in_dir, out_dir, filenames, manifest, poni_hash, npt, unit)
+    if verbose:
+        print(f"{len(changed)} of {len(entries)} images are new or changed")
+    if len(changed) == 0:
+        return []
+
+    written = []
+    try:
+        if workers == 1:
+            azim_int = pyFAI.load(poni_file) if cache_dir is None else CachedIntegrator(poni_file, cache_dir)
+            for in_filename, out_filepath in integrate_stream(azim_int, in_dir, out_dir, npt, unit, changed, verbose):
+                written.append((in_filename, out_filepath))
+                manifest[in_filename] = entries[in_filename]
+        else:
+            for in_filename, out_filepath in iter_integrate_parallel(poni_file, in_dir, out_dir, npt, unit, changed,
+                                                                     workers, threads, verbose, cache_dir=cache_dir):
+                written.append((in_filename, out_filepath))
+                manifest[in_filename] = entries[in_filename]
+    finally:
+        # keep whatever was completed, even if interrupted
+        save_manifest(manifest, manifest_path)
+    return written